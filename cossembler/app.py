@@ -17,6 +17,7 @@
 
 
 import logging
+import re
 
 from fmpy import read_model_description
 
@@ -29,125 +30,197 @@ from cossembler.eng import Demux
 from cossembler.eng import TXBuffer
 from cossembler.eng import RXBuffer
 from cossembler.fmpya import FMPY
+from cossembler.pfa import NativePF
+
+
+class MatpowerMap(object):
+
+    # Table-driven translation of the PowerFlow/SCUC 'inputs' and 'outputs' into MATLAB set/get expressions.
+    # An entry is a quantity with an optional MATLAB index: 'Pd', 'Pd(2)', 'Pd([2 5 9])' or 'Pd(2:5)'. Every
+    # entry is one pin of the block. For quantities marked 'merge', entries with a single index are merged
+    # into one variable and one vectorized expression, e.g. 'Pd(2)' and 'Pd(5)' become cs.bus([2 5],3)=Pd_1.
+    #
+    # Table entries: 'set'/'get' is the expression with {idx} and {var} placeholders, 'whole' the one used
+    # without an index (default: 'set'/'get' with {idx} = ':'), 'var' a fixed variable name, 'batch' marks
+    # inputs that change per snapshot in batch mode and 'type' the (whole, single) output pin types.
+
+    def __init__(self, inputs, outputs):
+        self.inputs = inputs
+        self.outputs = outputs
+
+    def parse(self, entry):                                             # 'Pd(2)' -> ('Pd', '2')
+        pom = re.match(r"^\s*(\w+)\s*(?:\((.*)\))?\s*$", entry)
+        if pom is None:
+            raise Exception("MatpowerMap.parse(): Cannot parse " + entry + ".")
+        idx = pom.group(2)
+        if idx is not None:
+            idx = idx.strip()
+        return pom.group(1), idx
+
+    def _groups(self, entries, table, io):
+        groups = []
+        merged = {}
+        for i in range(0, len(entries)):
+            q, idx = self.parse(entries[i])
+            if q not in table:
+                logging.warning("MatpowerMap : " + io + " " + entries[i] + " is not supported and is ignored.")
+                continue
+            spec = table[q]
+            if idx is None:
+                kind = 'whole'
+            elif re.match(r"^\d+$", idx):
+                kind = 'single'
+            else:
+                kind = 'vector'
+            if kind == 'single' and 'merge' in spec and spec['merge']:
+                if q in merged:
+                    g = merged[q]
+                    g['index'].append(idx)
+                    g['pins'].append(i + 1)
+                    g['idx'] = "[" + " ".join(g['index']) + "]"
+                    g['kind'] = 'packed'
+                    continue
+                g = {'q': q, 'kind': kind, 'index': [idx], 'idx': idx, 'pins': [i + 1]}
+                merged[q] = g
+            else:
+                if kind == 'vector' and not ('merge' in spec and spec['merge']):
+                    raise Exception("MatpowerMap : " + io + " " + entries[i] + " can only be indexed by a single number.")
+                g = {'q': q, 'kind': kind, 'index': [idx], 'idx': idx if idx else ":", 'pins': [i + 1]}
+            groups.append(g)
+        for i in range(0, len(groups)):                                 # variable names
+            g = groups[i]
+            if 'var' in table[g['q']]:
+                g['var'] = table[g['q']]['var']
+            elif g['kind'] == 'whole':
+                g['var'] = g['q']
+            elif g['kind'] == 'single':
+                g['var'] = g['q'] + g['idx']
+            else:
+                g['var'] = g['q'] + "_" + str(i + 1)
+        return groups
+
+    def _expr(self, spec, key, g, var=""):
+        pom = spec[key]
+        if g['kind'] == 'whole' and 'whole' in spec:
+            pom = spec['whole']
+        return pom.replace("{idx}", g['idx']).replace("{var}", var)
+
+    def setInputs(self, tool, entries, batch=False):                    # adds variables and set commands to the MATLAB element tool
+        groups = self._groups(entries, self.inputs, 'input')
+        snapshot = {'whole': "(k,:)'", 'vector': "(k,:)'", 'single': "(k)", 'packed': "(:,k)"}
+        if batch:                                                       # the loop over the snapshots is closed by setOutputs
+            pom = [g for g in groups if 'batch' in self.inputs[g['q']] and self.inputs[g['q']]['batch']]
+            if not pom:
+                raise Exception("MatpowerMap.setInputs(): Batch mode needs an input that changes per snapshot (e.g. Pd or Qd).")
+            tool.setCommand("for k = 1:size(" + pom[0]['var'] + ", " + ("2" if pom[0]['kind'] == 'packed' else "1") + ")")
+        for g in groups:
+            spec = self.inputs[g['q']]
+            tool.setVar(g['var'], g['pins'])
+            var = g['var']
+            if batch and 'batch' in spec and spec['batch']:
+                var = var + snapshot[g['kind']]
+            tool.setCommand(self._expr(spec, 'set', g, var))
+
+    def setOutputs(self, tool, entries, prefix, batch=False):           # adds output pins and get commands to the MATLAB element tool
+        groups = self._groups(entries, self.outputs, 'output')
+        tool.output.clear()
+        for i in range(0, len(entries)):
+            q, idx = self.parse(entries[i])
+            types = (VALUETYPES.VECTOR, VALUETYPES.REAL)
+            if q in self.outputs and 'type' in self.outputs[q]:
+                types = self.outputs[q]['type']
+            pom = types[0] if idx is None or not re.match(r"^\d+$", idx) else types[1]
+            if batch:                                                   # one more dimension for the snapshots
+                pom = VALUETYPES.VECTOR if pom == VALUETYPES.REAL else VALUETYPES.MATRIX
+            tool.createPin('out', pom, prefix + "." + entries[i].replace("(", "").replace(")", ""))
+        for i in range(0, len(groups)):
+            g = groups[i]
+            pom = self._expr(self.outputs[g['q']], 'get', g)
+            if batch:
+                tool.setCommand("res" + str(i + 1) + "(k,:) = reshape((" + pom + ")', 1, [])")
+            else:
+                tool.setOutCommand(pom, g['pins'])
+        if batch:
+            tool.setCommand("end")
+            for i in range(0, len(groups)):                             # single entries and merged groups come with one row per pin
+                g = groups[i]
+                tool.setOutCommand("res" + str(i + 1) + ("'" if g['kind'] in ['single', 'packed'] else ""), g['pins'])
+
+
+PFINPUTS = {
+    'Pg'    : {'set': "cs.gen({idx},2)={var}", 'merge': True},
+    'Vg'    : {'set': "cs.gen({idx},6)={var}", 'merge': True},
+    'Pd'    : {'set': "cs.bus({idx},3)={var}", 'merge': True, 'batch': True},
+    'Qd'    : {'set': "cs.bus({idx},4)={var}", 'merge': True, 'batch': True},
+    'slack' : {'set': "cs.bus(cs.bus(:,2)==3,2)=2; cs.bus({var},2)=3", 'var': 'sl'}
+}
+
+PFOUTPUTS = {
+    'Vm'    : {'get': "pfsol.bus({idx},8)'", 'merge': True},
+    'Va'    : {'get': "pfsol.bus({idx},9)'", 'merge': True},
+    'Pd'    : {'get': "pfsol.bus({idx},3)'", 'merge': True},
+    'Qd'    : {'get': "pfsol.bus({idx},4)'", 'merge': True},
+    'Pg'    : {'get': "pfsol.gen({idx},2)'", 'merge': True},
+    'Qg'    : {'get': "pfsol.gen({idx},3)'", 'merge': True},
+    'Pflow' : {'get': "[pfsol.branch(:,14) pfsol.branch(:,16)]'", 'type': (VALUETYPES.MATRIX, VALUETYPES.MATRIX)},
+    'Qflow' : {'get': "[pfsol.branch(:,15) pfsol.branch(:,17)]'", 'type': (VALUETYPES.MATRIX, VALUETYPES.MATRIX)},
+    'PQloss': {'get': "[pfsol.branch(:,14)+pfsol.branch(:,16) pfsol.branch(:,15)+pfsol.branch(:,17)]'", 'type': (VALUETYPES.MATRIX, VALUETYPES.MATRIX)}
+}
+
+SCUCINPUTS = {
+    'Pd'    : {'set': "profiles(indin=={idx}).values={var}", 'whole': "profiles(length(iwind)+1:length(profiles)).values={var}"},
+    'Pren'  : {'set': "profiles(indin=={idx}).values={var}", 'whole': "profiles(1:length(iwind)).values={var}"},
+    'slack' : {'set': "mpc.bus(mpc.bus(:,2)==3,2)=2; mpc.bus({var},2)=3", 'var': 'sl'}
+}
+
+SCUCOUTPUTS = {
+    'Pg'    : {'get': "mdo.results.Pc(indout=={idx},:)", 'whole': "mdo.results.Pc(1:length(indout),:)", 'type': (VALUETYPES.MATRIX, VALUETYPES.VECTOR)}
+}
+
+ROLLINGSCUCOUTPUTS = {                                                  # only the periods the window is shifted by
+    'Pg'    : {'get': "mdo.results.Pc(indout=={idx},1:shift)", 'whole': "mdo.results.Pc(1:length(indout),1:shift)", 'type': (VALUETYPES.MATRIX, VALUETYPES.VECTOR)}
+}
 
 
 class PowerFlow(Canvas,WorldConnector):
 
     def __init__(self, name, options):
         super().__init__(name,options)
+        if 'inputs' not in options:
+            raise Exception("PowerFlow.init(): Inputs must be provided.")
+        if 'outputs' not in options:
+            raise Exception("PowerFlow.init(): Outputs must be provided.")
         if (options['tool']=="MATPOWER"):
             self.myTool = MATLAB('matlabPF',VALUETYPES.MATRIX,options)
+            stateful = 'stateful' in options and options['stateful']            # load the case once and warm-start every power flow from the last one
+            if stateful:
+                setInit = self.myTool.setInitCommand
+                self.myTool.setPersistent('cs')
+                self.myTool.setPersistent('mpopt')
+            else:
+                setInit = self.myTool.setCommand
             if options['model_path'] is not "":
-                self.myTool.setCommand("cd '"+options['model_path']+"'")
-            self.myTool.setCommand('cs = ' + options['model'])
-            if 'inputs' not in options:
-                raise Exception("PowerFlow.init(): Inputs must be provided.")
-            if 'outputs' not in options:
-                raise Exception("PowerFlow.init(): Outputs must be provided.")
-            for i in range(0, len(options['inputs'])):
-                pom = options['inputs'][i]
-                if pom.find("Pg")>=0:
-                    if len(pom)>2:
-                        s = pom[pom.find('Pg') + 3:pom.find(')')]
-                        self.myTool.setCommand("cs.gen("+s+",2)=Pg"+s+";")
-                        self.myTool.setCommand("Pg" + s)                        # only for the sake of output
-                        self.myTool.setVar("Pg" + s)
-                    else:
-                        self.myTool.setCommand("Pg")                            # only for the sake of output
-                        self.myTool.setCommand("cs.gen(:,2)=Pg;")
-                        self.myTool.setVar("Pg")
-                if pom.find("Vg")>=0:
-                    if len(pom)>2:
-                        s = pom[pom.find('Vg') + 3:pom.find(')')]
-                        self.myTool.setCommand("cs.gen("+s+",6)=Vg"+s+";")
-                        self.myTool.setCommand("Vg" + s)                        # only for the sake of output
-                        self.myTool.setVar("Vg" + s)
-                    else:
-                        self.myTool.setCommand("cs.gen(:,6)=Vg;")
-                        self.myTool.setVar("Vg")
-                if pom.find("Pd")>=0:
-                    if len(pom)>2:
-                        s = pom[pom.find('Pd') + 3:pom.find(')')]
-                        self.myTool.setCommand("cs.bus("+s+",3)=Pd"+s+";")
-                        self.myTool.setCommand("Pd"+s)                          # only for the sake of output
-                        self.myTool.setVar("Pd"+s)
-                    else:
-                        self.myTool.setCommand("cs.bus(:,3)=Pd;")
-                        self.myTool.setVar("Pd")
-                if pom.find("Qd")>=0:
-                    if len(pom)>2:
-                        s = pom[pom.find('Qd') + 3:pom.find(')')]
-                        self.myTool.setCommand("cs.bus("+s+",4)=Qd"+s+";")
-                        self.myTool.setCommand("Qd" + s)                        # only for the sake of output
-                        self.myTool.setVar("Qd" + s)
-                    else:
-                        self.myTool.setCommand("cs.bus(:,4)=Qd")
-                        self.myTool.setVar("Qd")
-                if pom == "slack":
-                    self.myTool.setCommand("cs.bus(cs.bus(:,2)==3,2)=2;")
-                    self.myTool.setCommand("cs.bus(sl,2)=3;")
-                    self.myTool.setVar("sl")
-            self.myTool.setCommand("pfsol=runpf(cs)")
+                setInit("cd '"+options['model_path']+"'")
+            setInit('cs = ' + options['model'])
+            if stateful:
+                setInit("mpopt = mpoption('verbose', 0, 'out.all', 0)")
+            batch = 'batch' in options and options['batch']                      # Pd/Qd come as snapshots x buses, solved in one call
+            pfMap = MatpowerMap(PFINPUTS, PFOUTPUTS)
+            pfMap.setInputs(self.myTool, options['inputs'], batch)
+            if stateful:
+                self.myTool.setCommand("pfsol=runpf(cs, mpopt)")
+                self.myTool.setCommand("if pfsol.success, cs.bus(:,8:9) = pfsol.bus(:,8:9); end")   # the next runpf starts from this solution
+            else:
+                self.myTool.setCommand("pfsol=runpf(cs)")
+            pfMap.setOutputs(self.myTool, options['outputs'], name, batch)
+        elif (options['tool']=="NATIVE"):                                       # in-process solver, no MATLAB needed
+            self.myTool = NativePF('nativePF',VALUETYPES.MATRIX,options)
             self.myTool.output.clear()
             for i in range(0,len(options['outputs'])):
                 pom = options['outputs'][i]
-                if pom.find("Vm")>=0:
-                    if len(pom) > 2:
-                        s = pom[pom.find('Vm') + 3:pom.find(')')]
-                        self.myTool.setOutCommand("pfsol.bus("+s+",8)'")
-                        self.myTool.createPin('out', VALUETYPES.REAL, name + ".Vm"+s)
-                    else:
-                        self.myTool.setOutCommand("pfsol.bus(:,8)'")
-                        self.myTool.createPin('out',VALUETYPES.VECTOR,name+".Vm")
-                if pom.find("Va")>=0:
-                    if len(pom) > 2:
-                        s = pom[pom.find('Va') + 3:pom.find(')')]
-                        self.myTool.setOutCommand("pfsol.bus("+s+",9)'")
-                        self.myTool.createPin('out', VALUETYPES.REAL, name + ".Va"+s)
-                    else:
-                        self.myTool.setOutCommand("pfsol.bus(:,9)'")
-                        self.myTool.createPin('out',VALUETYPES.VECTOR,name+".Va")
-                if pom.find("Pd")>=0:
-                    if len(pom) > 2:
-                        s = pom[pom.find('Pd') + 3:pom.find(')')]
-                        self.myTool.setOutCommand("pfsol.bus("+s+",3)'")
-                        self.myTool.createPin('out', VALUETYPES.REAL, name + ".Pd"+s)
-                    else:
-                        self.myTool.setOutCommand("pfsol.bus(:,3)'")
-                        self.myTool.createPin('out',VALUETYPES.VECTOR,name+".Pd")
-                if pom.find("Qd")>=0:
-                    if len(pom) > 2:
-                        s = pom[pom.find('Qd') + 3:pom.find(')')]
-                        self.myTool.setOutCommand("pfsol.bus("+s+",4)'")
-                        self.myTool.createPin('out', VALUETYPES.REAL, name + ".Qd"+s)
-                    else:
-                        self.myTool.setOutCommand("pfsol.bus(:,4)'")
-                        self.myTool.createPin('out',VALUETYPES.VECTOR,name+".Qd")
-                if pom.find("Pg")>=0:
-                    if len(pom) > 2:
-                        s = pom[pom.find('Pg') + 3:pom.find(')')]
-                        self.myTool.setOutCommand("pfsol.gen("+s+",2)'")
-                        self.myTool.createPin('out', VALUETYPES.REAL, name + ".Pg"+s)
-                    else:
-                        self.myTool.setOutCommand("pfsol.gen(:,2)'")
-                        self.myTool.createPin('out',VALUETYPES.VECTOR,name+".Pg")
-                if pom.find("Qg")>=0:
-                    if len(pom) > 2:
-                        s = pom[pom.find('Qg') + 3:pom.find(')')]
-                        self.myTool.setOutCommand("pfsol.gen("+s+",3)'")
-                        self.myTool.createPin('out', VALUETYPES.REAL, name + ".Qg"+s)
-                    else:
-                        self.myTool.setOutCommand("pfsol.gen(:,3)'")
-                        self.myTool.createPin('out',VALUETYPES.VECTOR,name+".Qg")
-                if options['outputs'][i] == "Pflow":
-                    self.myTool.setOutCommand("[pfsol.branch(:,14) pfsol.branch(:,16)]'")
-                    self.myTool.createPin('out',VALUETYPES.MATRIX,name+".Pflow")
-                if options['outputs'][i] == "Qflow":
-                    self.myTool.setOutCommand("[pfsol.branch(:,15) pfsol.branch(:,17)]'")
-                    self.myTool.createPin('out',VALUETYPES.MATRIX,name+".Qflow")
-                if options['outputs'][i] == "PQloss":
-                    self.myTool.setOutCommand("[pfsol.branch(:,14)+pfsol.branch(:,16) pfsol.branch(:,15)+pfsol.branch(:,17)]'")
-                    self.myTool.createPin('out',VALUETYPES.MATRIX,name+".PQloss")
+                self.myTool.createPin('out',self.myTool.pinType(pom),name+"."+pom.replace("(","").replace(")",""))
+        else:
+            raise Exception("PowerFlow.init(): Tool can either be 'MATPOWER' or 'NATIVE'.")
 
         for i in range(0,len(options['inputs'])-1):
             self.myTool.createFlexInputPin()
@@ -162,10 +235,12 @@ class PowerFlow(Canvas,WorldConnector):
         return self.myTool
 
     def connectToTheWorld(self):
-        self.myTool.connectToTheWorld()
+        if isinstance(self.myTool, WorldConnector):
+            self.myTool.connectToTheWorld()
 
     def disconnectFromTheWorld(self):
-        self.myTool.disconnectFromTheWorld()
+        if isinstance(self.myTool, WorldConnector):
+            self.myTool.disconnectFromTheWorld()
 
     def doFunc(self):
         super().doFunc()
@@ -177,66 +252,48 @@ class SCUC(Canvas,WorldConnector):
         super().__init__(name,options)
         if (options['tool']=="MATPOWER"):
             self.myTool = MATLAB('matlabSCUC',VALUETYPES.MATRIX,options)
-            if options['model_path'] is not "":
-                self.myTool.setCommand("cd '"+options['model_path']+"'")
-            self.myTool.setCommand('cs = ' + options['model']+';')
-            self.myTool.setCommand('mpc = loadcase(cs);')
-            self.myTool.setCommand('indout = mpc.gen(:,1);')
-            self.myTool.setCommand('xgd = loadxgendata('+options['model']+'_ex_xgd_uc, mpc);')
-            self.myTool.setCommand('pom = '+options['model']+'_ex_wind_uc;')
-            self.myTool.setCommand('pom = pom.gen(:, 1);')
-            self.myTool.setCommand('[iwind, mpc, xgd] = addwind('+options['model']+'_ex_wind_uc, mpc, xgd);')
-            self.myTool.setCommand('profiles = getprofiles('+options['model']+'_ex_wind_profile, iwind);')
-            self.myTool.setCommand('profiles = getprofiles('+options['model']+'_ex_load_profile, profiles);')
-            self.myTool.setCommand("indin = extractfield(profiles,'rows');")
-            self.myTool.setCommand('indin(size(pom)) = pom;')
-            self.myTool.setCommand('Pren12')
+            self._loadCommands(options)
+            self.myTool.setCommand('profiles = profiles0;')                      # only the profiles are patched in every call
             if 'inputs' not in options:
-                raise Exception("PowerFlow.init(): Inputs must be provided.")
+                raise Exception("SCUC.init(): Inputs must be provided.")
             if 'outputs' not in options:
-                raise Exception("PowerFlow.init(): Outputs must be provided.")
-            for i in range(0, len(options['inputs'])):
-                pom = options['inputs'][i]
-                if pom.find("Pd")>=0:
-                    if len(pom)>2:
-                        s = pom[pom.find('Pd') + 3:pom.find(')')]
-                        self.myTool.setCommand("profiles(indin=="+s+").values=Pd"+s+";")
-                        self.myTool.setVar("Pd" + s)
-                    else:
-                        self.myTool.setCommand("profiles(length(iwind)+1:length(profiles)).values=Pd;")
-                        self.myTool.setVar("Pd")
-                if pom.find("Pren")>=0:
-                    if len(pom)>4:
-                        s = pom[pom.find('Pren') + 5:pom.find(')')]
-                        self.myTool.setCommand("profiles(indin=="+s+").values=Pren"+s+";")
-                        self.myTool.setVar("Pren" + s)
-                    else:
-                        self.myTool.setCommand("profiles(1:length(iwind)).values=Pren;")
-                        self.myTool.setVar("Pren")
-                if pom == "slack":
-                    self.myTool.setCommand("cs.bus(cs.bus(:,2)==3,2)=2;")
-                    self.myTool.setCommand("cs.bus(sl,2)=3;")
-                    self.myTool.setVar("sl")
-            self.myTool.setCommand("nt = size(profiles(1).values, 1);")
-            self.myTool.setCommand("mdi = loadmd(mpc, nt, xgd, [], [], profiles);")
-            self.myTool.setCommand("mdo = most(mdi);")
-            self.myTool.output.clear()
-            for i in range(0,len(options['outputs'])):
-                pom = options['outputs'][i]
-                if pom.find("Pg") >= 0:
-                    if len(pom) > 2:
-                        s = pom[pom.find('Pg') + 3:pom.find(')')]
-                        self.myTool.setOutCommand("mdo.results.Pc(indout=="+s+",:)")
-                        self.myTool.createPin('out',VALUETYPES.VECTOR,name+".Pg"+s)
-                    else:
-                        self.myTool.setOutCommand("mdo.results.Pc(1:length(indout),:)")
-                        self.myTool.createPin('out',VALUETYPES.MATRIX,name+".Pg")
+                raise Exception("SCUC.init(): Outputs must be provided.")
+            scucMap = MatpowerMap(SCUCINPUTS, self._outputTable())
+            scucMap.setInputs(self.myTool, options['inputs'])
+            self._solveCommands(options)
+            scucMap.setOutputs(self.myTool, options['outputs'], name)     # options['cache'] caches the MATLAB block; MOST gives the same commitment for the same profiles
 
         for i in range(0,len(options['inputs'])-1):
             self.myTool.createFlexInputPin()
 
         self.add_element(self.myTool)
 
+    def _loadCommands(self, options):                                   # the static data is loaded in the first call only
+        for i in ['mpc', 'indout', 'xgd', 'iwind', 'profiles0', 'indin', 'mpopt']:
+            self.myTool.setPersistent(i)
+        if options['model_path'] is not "":
+            self.myTool.setInitCommand("cd '"+options['model_path']+"'")
+        self.myTool.setInitCommand('cs = ' + options['model']+';')
+        self.myTool.setInitCommand('mpc = loadcase(cs);')
+        self.myTool.setInitCommand('indout = mpc.gen(:,1);')
+        self.myTool.setInitCommand('xgd = loadxgendata('+options['model']+'_ex_xgd_uc, mpc);')
+        self.myTool.setInitCommand('pom = '+options['model']+'_ex_wind_uc;')
+        self.myTool.setInitCommand('pom = pom.gen(:, 1);')
+        self.myTool.setInitCommand('[iwind, mpc, xgd] = addwind('+options['model']+'_ex_wind_uc, mpc, xgd);')
+        self.myTool.setInitCommand('profiles0 = getprofiles('+options['model']+'_ex_wind_profile, iwind);')
+        self.myTool.setInitCommand('profiles0 = getprofiles('+options['model']+'_ex_load_profile, profiles0);')
+        self.myTool.setInitCommand("indin = extractfield(profiles0,'rows');")
+        self.myTool.setInitCommand('indin(size(pom)) = pom;')
+        self.myTool.setInitCommand("mpopt = mpoption('verbose', 0);")
+
+    def _solveCommands(self, options):
+        self.myTool.setCommand("nt = size(profiles(1).values, 1);")
+        self.myTool.setCommand("mdi = loadmd(mpc, nt, xgd, [], [], profiles);")
+        self.myTool.setCommand("mdo = most(mdi, mpopt);")
+
+    def _outputTable(self):
+        return SCUCOUTPUTS
+
     def connect(self, right, pinout, pinin):
         super().connect(right, pinout, pinin)
         self.myTool.connect(right, pinout, pinin)
@@ -254,16 +311,65 @@ class SCUC(Canvas,WorldConnector):
         super().doFunc()
 
 
+class RollingSCUC(SCUC):
+
+    # Receding-horizon SCUC. options['horizon'] = {'window': W, 'shift': S}: every call solves the W periods
+    # starting at the window pointer, outputs the dispatch of the first S of them and moves the pointer by S.
+    # The pointer, the MOST data and the commitment state live in MATLAB between calls: the commitment and
+    # dispatch at the end of the shifted periods become xgd.InitialState and xgd.InitialPg of the next window.
+    # Pd/Pren inputs, if given, are profiles for the whole study. The results depend on the previous windows,
+    # so they are never cached.
+
+    def __init__(self, name, options):
+        if 'horizon' not in options or 'window' not in options['horizon'] or 'shift' not in options['horizon']:
+            raise Exception("RollingSCUC.init(): Horizon with window and shift must be provided.")
+        if options['horizon']['shift'] > options['horizon']['window'] or options['horizon']['shift'] < 1:
+            raise Exception("RollingSCUC.init(): Shift must be between 1 and the window length.")
+        super().__init__(name, options)
+        self.myTool.myCache = None
+
+    def _solveCommands(self, options):
+        self.myTool.setPersistent('t0')
+        self.myTool.setInitCommand("t0 = 1;")
+        self.myTool.setCommand("window = " + str(options['horizon']['window']) + ";")
+        self.myTool.setCommand("shift = " + str(options['horizon']['shift']) + ";")
+        self.myTool.setCommand("nT = size(profiles(1).values, 1);")
+        self.myTool.setCommand("if t0 > nT, error('RollingSCUC: the profiles end at period %d.', nT); end")
+        self.myTool.setCommand("t1 = min(t0 + window - 1, nT);")
+        self.myTool.setCommand("shift = min(shift, t1 - t0 + 1);")
+        self.myTool.setCommand("for j = 1:numel(profiles), profiles(j).values = profiles(j).values(t0:t1,:,:); end")
+        self.myTool.setCommand("nt = t1 - t0 + 1;")
+        self.myTool.setCommand("mdi = loadmd(mpc, nt, xgd, [], [], profiles);")
+        self.myTool.setCommand("mdo = most(mdi, mpopt);")
+        # carry the state at the end of the shifted periods into the next window
+        self.myTool.setCommand("u = mdo.UC.CommitSched(:, 1:shift);")
+        self.myTool.setCommand("st = zeros(size(u, 1), 1);")
+        self.myTool.setCommand("for i = 1:size(u, 1)")
+        self.myTool.setCommand("n = find(u(i,:) ~= u(i,end), 1, 'last');")
+        self.myTool.setCommand("if isempty(n), c = shift + abs(xgd.InitialState(i)) * (sign(xgd.InitialState(i)) == 2*u(i,end)-1); else, c = shift - n; end")
+        self.myTool.setCommand("st(i) = c * (2*u(i,end)-1);")
+        self.myTool.setCommand("end")
+        self.myTool.setCommand("xgd.InitialState = st;")
+        self.myTool.setCommand("xgd.InitialPg = mdo.results.ExpectedDispatch(:, shift);")
+        self.myTool.setCommand("t0 = t0 + shift;")
+
+    def _outputTable(self):
+        return ROLLINGSCUCOUTPUTS
+
+
 class FMPYtranslator(object):
 
     # '_0' or '_init' mark initialization variable,
     # '_time' or '_t' marks a signal,
     # no mark means one value for input that is not an initial value and is not a signal either but a constant input throughout the run
+    # the model variables are indexed once, on the first translate(), and every translation is then a lookup
 
     def __init__(self,myLib,type="DEFAULT"):
 
         self.myType = type
         self.myVarLibrary = myLib
+        self.myIndex = None
+        self.myCache = {}                                                       # varName -> translated names
 
     def isInit(self,varName):
         if not isinstance(varName,str):
@@ -285,17 +391,11 @@ class FMPYtranslator(object):
             sig = True
         return sig
 
+    def _index(self):
+        self.myIndex = {'names': set(variable.name for variable in self.myVarLibrary)}
 
-    def translate(self, varName):
-        if not self.myVarLibrary:
-            #print("Error! IPSLTranslate.translate(): myVarLibrary must be specified")
-            logging.error("Error! IPSLTranslate.translate(): myVarLibrary must be specified")
-            return
-        if not isinstance(varName, str):
-            #print("Error! IPSLTranslate.translate(): varName must be a string")
-            logging.error("Error! IPSLTranslate.translate(): varName must be a string")
-            return
-
+    def _strip(self, varName):
+        # remove additions for initialization or for signal
         if varName.find("_0")!=-1:
             varName = varName.replace("_0","")
         if varName.find("_init")!=-1:
@@ -304,155 +404,120 @@ class FMPYtranslator(object):
             varName = varName.replace("_time","")
         if varName.find("_t")!=-1:
             varName = varName.replace("_t","")
+        return varName
 
-        outNames = []
-        for variable in self.myVarLibrary:
-            if variable.name == varName:
-                outNames.append(variable.name)
-                return outNames
+    def _check(self, varName):
+        if not self.myVarLibrary:
+            #print("Error! IPSLTranslate.translate(): myVarLibrary must be specified")
+            logging.error("Error! IPSLTranslate.translate(): myVarLibrary must be specified")
+            return False
+        if not isinstance(varName, str):
+            #print("Error! IPSLTranslate.translate(): varName must be a string")
+            logging.error("Error! IPSLTranslate.translate(): varName must be a string")
+            return False
+        if self.myIndex is None:
+            self._index()
+        return True
+
+    def translate(self, varName):
+        if not self._check(varName):
+            return
+
+        varName = self._strip(varName)
+        if varName in self.myIndex['names']:
+            return [varName]
 
 
 class IPSLtranslator(FMPYtranslator):
 
+    # index of the IPSL variables:
+    #   'init' - Pg, Qg, Pd, Qd -> the P_0/Q_0 variables of generators/loads sorted by bus number (gen1.gen.P_0 entries excluded)
+    #   'kind' - gen, load -> (all variables, input variables) of that kind
+    #   'bus'  - gen, load -> bus number (as written) -> (all variables, input variables) of gen<n>/Gen<n> or load<n>/Load<n>
+
+    KINDS = {'gen': re.compile(r"[gG]en(\d+)"), 'load': re.compile(r"[lL]oad(\d+)")}
+
     def __init__(self,myLib):
         super().__init__(myLib,"IPSL")
 
-    def _myLen(self,e):
-        return len(e)
-
     def getIndex(self,tranIn):
-        import re
         spk = []
         for j in tranIn:
-            k = re.findall("\d+", j)
+            k = re.findall(r"\d+", j)
             spk.append(int(k[0]))
         return spk
 
+    def _initKey(self, name):
+        if name[0]=="L":                                                        # Load1 sorts along load1
+            name = name.replace("L","l")
+        return (len(name), name)                                                # by length, then by name: load1, load2, load3, load11, load12
+
+    def _index(self):
+        super()._index()
+        init = {'Pg': [], 'Qg': [], 'Pd': [], 'Qd': []}
+        kinds = {}
+        buses = {}
+        for kind in self.KINDS:
+            kinds[kind] = ([], [])
+            buses[kind] = {}
+        for variable in self.myVarLibrary:
+            name = variable.name
+            inp = variable.causality=="input"
+            for kind in self.KINDS:
+                if name.find(kind)<0 and name.find(kind.capitalize())<0:
+                    continue
+                kinds[kind][0].append(name)
+                if inp:
+                    kinds[kind][1].append(name)
+                for num in set(self.KINDS[kind].findall(name)):
+                    pom = buses[kind].setdefault(num, ([], []))
+                    pom[0].append(name)
+                    if inp:
+                        pom[1].append(name)
+                if kind=='gen' and name.find(".gen.")>=0:                      # skip all gen1.gen.P_0 entries
+                    continue
+                if name.find("P_0")>=0:
+                    init['Pg' if kind=='gen' else 'Pd'].append(name)
+                if name.find("Q_0")>=0:
+                    init['Qg' if kind=='gen' else 'Qd'].append(name)
+        for pom in init:
+            init[pom].sort(key=self._initKey)
+        self.myIndex['init'] = init
+        self.myIndex['kind'] = kinds
+        self.myIndex['bus'] = buses
+
     def translate(self, varName):
-        if not self.myVarLibrary:
-            #print("Error! IPSLTranslate.translate(): myVarLibrary must be specified")
-            logging.error("Error! IPSLTranslate.translate(): myVarLibrary must be specified")
-            return
-        if not isinstance(varName,str):
-            #print("Error! IPSLTranslate.translate(): varName must be a string")
-            logging.error("Error! IPSLTranslate.translate(): varName must be a string")
+        if not self._check(varName):
             return
 
-        outNames = []
-        for variable in self.myVarLibrary:
-            if variable.name==varName:
-                outNames.append(variable.name)
-                return outNames
-
+        if varName in self.myCache:
+            return list(self.myCache[varName])
 
-        init = False
-        signal = False
-        # remove additions for initialization or for signal
-        if varName.find("_0")!=-1:
-            varName = varName.replace("_0","")
-            init = True
-        if varName.find("_init")!=-1:
-            varName = varName.replace("_init","")
-            init = True
-        if varName.find("_time")!=-1:
-            varName = varName.replace("_time","")
-            signal = True
-        if varName.find("_t")!=-1:
-            varName = varName.replace("_t","")
-            signal = True
-
-
-
-#        outBusNum = []
-        if init:
-            if varName=="Pg":
-                for variable in self.myVarLibrary:
-                    if (variable.name.find("gen")>=0 or variable.name.find("Gen")>=0) and variable.name.find("P_0")>=0:
-                        outNames.append(variable.name)
-                for pom in outNames:                                            # remove all gen1.gen.P_0 enteries
-                    if pom.find(".gen.")>=0:
-                        outNames.remove(pom)
-                outNames.sort()                                                 # sort by number:  load1, load11, load12, load2, load3
-                outNames.sort(key=self._myLen)                                  # sort by length:  load1, load2, load3, load11, load12
-            elif varName=="Qg":
-                for variable in self.myVarLibrary:
-                    if (variable.name.find("gen")>=0 or variable.name.find("Gen")>=0) and variable.name.find("Q_0")>=0:
-                        outNames.append(variable.name)
-                for pom in outNames:                                            # remove all gen1.gen.P_0 enteries
-                    if pom.find(".gen.") >= 0:
-                        outNames.remove(pom)
-                outNames.sort()                                                 # sort by number:  load1, load11, load12, load2, load3
-                outNames.sort(key=self._myLen)                                  # sort by length:  load1, load2, load3, load11, load12
-            elif varName=="Pd":
-                for variable in self.myVarLibrary:
-                    if (variable.name.find("Load")>=0 or variable.name.find("load")>=0) and variable.name.find("P_0")>=0:
-                        outNames.append(variable.name)
-    #                    s = variable[4:variable.find('.')]
-    #                    outBusNum.append(int(s))
-                utol = outNames.copy()
-                for i in range(0,len(outNames)):
-                    if outNames[i][0]=="L":
-                        outNames[i] = outNames[i].replace("L","l")
-                outNames.sort()                                               # sort by number:  load1, load11, load12, load2, load3
-                outNames.sort(key=self._myLen)                                # sort by length:  load1, load2, load3, load11, load12
-                for i in range(0,len(outNames)):
-                    captrep = True
-                    for j in utol:
-                        if outNames[i]==j:
-                            captrep = False
-                            break
-                    if captrep:
-                        outNames[i] = outNames[i].replace("l","L")
-            elif varName=="Qd":
-                for variable in self.myVarLibrary:
-                    if (variable.name.find("Load")>=0 or variable.name.find("load")>=0) and variable.name.find("Q_0")>=0:
-                        outNames.append(variable.name)
-                utol = outNames.copy()
-                for i in range(0,len(outNames)):
-                    if outNames[i][0]=="L":
-                        outNames[i] = outNames[i].replace("L", "l")
-                outNames.sort()                                               # sort by number:  load1, load11, load12, load2, load3
-                outNames.sort(key=self._myLen)                                # sort by length:  load1, load2, load3, load11, load12
-                for i in range(0,len(outNames)):
-                    captrep = True
-                    for j in utol:
-                        if outNames[i]==j:
-                            captrep = False
-                            break
-                    if captrep:
-                        outNames[i] = outNames[i].replace("l", "L")
-    #        if varName=="Vm":
-    #            for variable in modelVariables:
-    #                if variable.find("load") and variable.find("Q_0"):
-    #                    outNames.append(variable)
+        if varName in self.myIndex['names']:
+            outNames = [varName]
+        elif self.isInit(varName):
+            outNames = list(self.myIndex['init'].get(self._strip(varName), []))
         else:
-            import re
-            s1 = varName
-            s2 = varName
-            if varName.find('Pg')>=0 or varName.find('Qg')>=0:
-                s1 = 'gen'
-                s2 = 'Gen'
-                k = re.findall("\d+", varName)
-                if len(k)>0:
-                    s1 = s1+k[0]
-                    s2 = s2+k[0]
-            if varName.find('Pd')>=0 or varName.find('Qd')>=0:
-                s1 = 'load'
-                s2 = 'Load'
-                k = re.findall("\d+", varName)
+            name = self._strip(varName)
+            kind = None
+            if name.find('Pg')>=0 or name.find('Qg')>=0:
+                kind = 'gen'
+            if name.find('Pd')>=0 or name.find('Qd')>=0:
+                kind = 'load'
+            if kind is None:
+                outNames = [variable.name for variable in self.myVarLibrary if variable.causality=="input" and variable.name.find(name)>=0]
+                if not outNames:
+                    outNames = [variable.name for variable in self.myVarLibrary if variable.name.find(name)>=0]
+            else:
+                k = re.findall(r"\d+", name)
                 if len(k)>0:
-                    s1 = s1+k[0]
-                    s2 = s2+k[0]
-            for variable in self.myVarLibrary:
-                if variable.causality=="input":
-                    if variable.name.find(s1)>=0 or variable.name.find(s2)>=0:
-                        outNames.append(variable.name)
-            if not outNames:
-                for variable in self.myVarLibrary:
-                    if variable.name.find(s1) >= 0 or variable.name.find(s2) >= 0:
-                        outNames.append(variable.name)
+                    pom = self.myIndex['bus'][kind].get(k[0], ([], []))
+                else:
+                    pom = self.myIndex['kind'][kind]
+                outNames = list(pom[1] or pom[0])                               # inputs first, any variable otherwise
 
-        return outNames
+        self.myCache[varName] = outNames
+        return list(outNames)
 
 
 class DynamicSimulationNoInit(Canvas):
@@ -703,3 +768,143 @@ class DynamicSimulation(Canvas):
         # if self.initMyTool:
         #     self.myTool.setInitializationCondition()
         super().doFunc()
+
+
+class FusedDynamicSimulation(FMPY):
+
+    # DynamicSimulation in a single element: the FMU is read once and every pin is mapped directly onto the value
+    # references of its translated FMU variables, without the Demux, Reflector, TXBuffer and RXBuffer elements in between.
+    # An input translated into several FMU variables takes a VECTOR (indexed by bus number for loads, as the Demux of
+    # DynamicSimulation does). A signal input ('_t', '_time') takes one sample per communication step (one row per FMU
+    # variable) and every token then runs all (Tstop-Tstart)/Tstep steps. Signal outputs collect one value per step.
+
+    def __init__(self, name, options):
+        if (options['tool'] != "IPSL") and (options['tool'] != "FMU"):
+            raise Exception("FusedDynamicSimulation.init(): Tool must be IPSL or FMU.")
+        if 'inputs' not in options:
+            raise Exception("FusedDynamicSimulation.init(): Inputs must be provided.")
+        if 'outputs' not in options:
+            raise Exception("FusedDynamicSimulation.init(): Outputs must be provided.")
+        if options['dyn'] != "step" or 'batch' in options or 'signals' in options:
+            raise Exception('FusedDynamicSimulation.init(): Only dyn="step" without "batch" and "signals" is supported.')
+
+        if 'fmu' in options:
+            myFMUid = options['fmu']
+        else:
+            myFMUid = options['model_path'] + '\\' + options['model'] + '.fmu'
+        modelDescription = read_model_description(myFMUid, validate=True)
+
+        if options['tool'] == "IPSL":
+            self.myTranslator = IPSLtranslator(modelDescription.modelVariables)
+        else:
+            self.myTranslator = FMPYtranslator(modelDescription.modelVariables)
+
+        super().__init__(name, options, modelDescription)
+        self.steps = int(round((self.Tstop - self.Tstart) / self.Tstep))
+        self.myStream = []
+
+    def _map(self, varName):                                            # value references of an input/output and the bus indices of its loads
+        names = self.myTranslator.translate(varName)
+        if not names:
+            raise Exception("FusedDynamicSimulation.init(): " + varName + " does not match any FMU variable.")
+        ind = None
+        if len(names) > 1 and (varName.find("Pd")>=0 or varName.find("Qd")>=0):
+            ind = [i-1 for i in self.myTranslator.getIndex(names)]
+        return [self.vrs[i] for i in names], ind
+
+    def _createPins(self):
+        self.FMUoutput = []                                             # all value references, read with a single getReal
+        self.outMap = []                                                # per output pin: (first reference, number of references, signal)
+        for i in self.options['outputs']:
+            refs, ind = self._map(i)
+            signal = self.myTranslator.isSignal(i)
+            self.outMap.append((len(self.FMUoutput), len(refs), signal))
+            self.FMUoutput += refs
+            if signal or len(refs) > 1:
+                self.createPin('out', VALUETYPES.VECTOR, i)
+            else:
+                self.createPin('out', VALUETYPES.REAL, i)
+
+        self.FMUinput = []                                              # references set every step
+        self.FMUinit = []                                               # references set at initialization
+        self.inMap = []                                                 # per input pin: (kind, number of references, bus indices)
+        self.hasSignal = False
+        for i in self.options['inputs']:
+            refs, ind = self._map(i)
+            if self.myTranslator.isSignal(i):
+                kind = 'signal'
+                self.hasSignal = True
+                self.FMUinput += refs
+                pinType = VALUETYPES.VECTOR if len(refs) == 1 else VALUETYPES.MATRIX
+            elif self.myTranslator.isInit(i):
+                kind = 'init'
+                self.FMUinit += refs
+                pinType = VALUETYPES.REAL if len(refs) == 1 else VALUETYPES.VECTOR
+            else:
+                kind = 'const'
+                self.FMUinput += refs
+                pinType = VALUETYPES.REAL if len(refs) == 1 else VALUETYPES.VECTOR
+            self.inMap.append((kind, len(refs), ind))
+            self.createPin('in', pinType, i)
+            if kind != 'const':
+                self.setInputCondition("edge{" + i + "}", 'init')
+
+    def _pick(self, value, n, ind):
+        if ind:
+            return [value[j] for j in ind]
+        return list(value[:n])
+
+    def _inputValues(self, kinds, k=0):                                 # values of the given kinds of inputs at step k
+        values = []
+        for i in range(0, len(self.inMap)):
+            kind, n, ind = self.inMap[i]
+            if kind not in kinds:
+                continue
+            pom = self.input[i]['value']
+            if kind == 'signal':
+                rows = [pom] if n == 1 else self._pick(pom, n, ind)
+                for row in rows:
+                    values.append(row[k % len(row)])                    # the samples repeat if the signal is shorter than the interval
+            elif n == 1:
+                values.append(pom)
+            else:
+                values += self._pick(pom, n, ind)
+        return values
+
+    def _startValues(self):
+        if self.firstRun == 0 and self.FMUinit:                         # the first compile happens before any input has arrived
+            self.myFMU.setReal(self.FMUinit, self._inputValues(['init']))
+
+    def doFunc(self):
+        n = self.steps if self.hasSignal else 1
+        for k in range(0, n):
+            inputValues = self._inputValues(['signal', 'const'], k)
+            if self.FMUinput:
+                self.myFMU.setReal(self.FMUinput, inputValues)
+
+            if self.options['type'] == 'CS':
+                if self.adapt:
+                    self._stepAdaptive(inputValues)
+                else:
+                    self._stepCS()
+            elif self.options['type'] == 'ME':
+                self._stepME()
+            else:
+                raise Exception("FusedDynamicSimulation.doFunc(): Please provide either 'ME' or 'CS' type.")
+
+            pom = self.myFMU.getReal(self.FMUoutput)
+            for i in range(0, len(self.outMap)):
+                start, size, signal = self.outMap[i]
+                value = pom[start] if size == 1 else list(pom[start:start+size])
+                if signal:
+                    self.myStream[i].append(value)
+                    value = self.myStream[i]
+                self.output[i]['value'] = value
+            self._record()
+
+        logging.debug("FusedDynamicSimulation element " + self.name + " : " + str(n) + " steps finished at " + str(self.time))
+
+    def compile(self):
+        self.myStream = [[] for i in self.outMap]
+        self._restart()
+        self.firstRun = 0
@@ -17,6 +17,12 @@
 
 
 import logging
+import heapq
+import copy
+import os
+import pickle
+import hashlib
+from collections import OrderedDict
 
 try:
     import Queue as Q  # ver. < 3.0
@@ -71,7 +77,10 @@ PRIORITYTABLE = {
     'TypeConversion'    : PRIORITY.HIGH,
     'ValueToTime'       : PRIORITY.HIGH,
     'TimeToValue'       : PRIORITY.HIGH,
-    'Ping'              : PRIORITY.BOTTOM
+    'Ping'              : PRIORITY.BOTTOM,
+    'FMPYGroup'         : PRIORITY.MEDIUM,
+    'MultiRateCanvas'   : PRIORITY.MEDIUM,
+    'EventCanvas'       : PRIORITY.MEDIUM
 }
 
 
@@ -563,6 +572,53 @@ class Condition(object):
 
 
 
+class ResultCache(object):
+
+    # Size-bounded LRU cache of element outputs keyed by a hash of the input pin values; used by Element.setCache().
+    # If a file is given, the cache is loaded from it when created and written back by save().
+
+    def __init__(self, size=128, file=None):
+        self.size = size
+        self.file = file
+        self.hits = 0
+        self.misses = 0
+        self.store = OrderedDict()
+        if file and os.path.exists(file):
+            with open(file, 'rb') as f:
+                self.store = pickle.load(f)
+            while len(self.store) > self.size:
+                self.store.popitem(last=False)
+
+    def key(self, inputs):
+        try:
+            pom = pickle.dumps([(i['type'], i['value']) for i in inputs], protocol=pickle.HIGHEST_PROTOCOL)
+        except (pickle.PicklingError, TypeError, AttributeError):
+            return None                                                 # such inputs cannot be cached
+        return hashlib.sha1(pom).hexdigest()
+
+    def get(self, key):
+        if key is None or key not in self.store:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.store.move_to_end(key)
+        return copy.deepcopy(self.store[key])
+
+    def put(self, key, values):
+        if key is None:
+            return
+        self.store[key] = copy.deepcopy(values)
+        self.store.move_to_end(key)
+        if len(self.store) > self.size:
+            self.store.popitem(last=False)
+
+    def save(self):
+        logging.info("ResultCache: " + str(self.hits) + " hits, " + str(self.misses) + " misses, " + str(len(self.store)) + " entries")
+        if self.file:
+            with open(self.file, 'wb') as f:
+                pickle.dump(self.store, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+
 class UniqueObject(object):
 
     name_list = [] # unique list of names for all elements in the environment
@@ -605,6 +661,19 @@ class Element(UniqueObject):
             self.setPriority(PRIORITY.DEFAULT)
         # self.priority = self.options['priority']
         self.myCanvas = None
+        self.rate = None                                                            # execution period inside a MultiRateCanvas; None means whenever triggered
+        self.rateOffset = 0.0
+        self.nextTime = 0.0                                                         # the time at which the element is due next (see MultiRateCanvas)
+        self.changed = None                                                         # output pins changed in the last execution; None means all (see Canvas option 'incremental')
+        self.lastOut = None                                                         # the last forwarded content of every output pin
+        self.outVersion = []                                                        # counts the changes of every output pin
+        self.myCache = None                                                         # results of a pure element keyed by its inputs (see setCache)
+        self.cacheKey = None                                                        # the key of a pending result that still has to be cached
+        if options and 'cache' in options:
+            if isinstance(options['cache'], dict):
+                self.setCache(**options['cache'])
+            elif options['cache']:
+                self.setCache()
 
 
     def createPin(self,io,type=VALUETYPES.DEFAULT,name="",cmd=""):
@@ -702,6 +771,8 @@ class Element(UniqueObject):
         if self.active:
             for i in range(0, len(self.nextElem)):
                 pom = self.nextElem[i]
+                if self.changed is not None and pom[ELEMADDRESS.PINOUT] not in self.changed:    # the value is already there
+                    continue
                 if len(pom[ELEMADDRESS.NEXTELEM].input)>0 and len(self.output)>0:       # Check if the next element has any inputs and if this element has any outputs
                     # (pom[ELEMADDRESS.NEXTELEM]).input[pom[ELEMADDRESS.PININ] - 1] = self.output[pom[ELEMADDRESS.PINOUT] - 1]                      # Copy the value of the output pin to the value of the input pin of the next element
                     copyMachine.copyAll((pom[ELEMADDRESS.NEXTELEM]).input[pom[ELEMADDRESS.PININ] - 1],self.output[pom[ELEMADDRESS.PINOUT] - 1])  # Copy the value of the output pin to the value of the input pin of the next element
@@ -713,6 +784,27 @@ class Element(UniqueObject):
     def accept(self, pinin):                                            # This function is used to accept connection. This is needed for Canvas since many internal components can be the one.
         return self
 
+    def markChanged(self):                                              # finds the output pins whose content changed since they were last forwarded
+        if self.lastOut is None or len(self.lastOut) != len(self.output):
+            self.lastOut = [None] * len(self.output)
+            self.outVersion = [0] * len(self.output)
+        self.changed = []
+        for i in range(0, len(self.output)):
+            if not self._sameMessage(self.output[i], self.lastOut[i]):
+                self.lastOut[i] = {'time': self.output[i]['time'], 'value': copy.deepcopy(self.output[i]['value'])}
+                self.outVersion[i] += 1
+                self.changed.append(i + 1)
+        return self.changed
+
+    def _sameMessage(self, msg, old):
+        if old is None or msg['time'] != old['time'] or type(msg['value']) != type(old['value']):
+            return False
+        try:
+            return bool(msg['value'] == old['value'])
+        except ValueError:                                                  # numpy arrays compare element-wise
+            import numpy
+            return numpy.array_equal(msg['value'], old['value'])
+
     def setInputCondition(self,s,a='stop'):
         self.myCondition.setCondition(s,'in',a)
 
@@ -731,6 +823,14 @@ class Element(UniqueObject):
     def setPriority(self,level):
         self.priority = level
 
+    def setCache(self,size=128,file=None):                              # only for pure elements: the same inputs always give the same outputs
+        self.myCache = ResultCache(size, file)
+
+    def setRate(self,rate,offset=0.0):
+        self.rate = rate
+        self.rateOffset = offset
+        self.nextTime = offset
+
     def execute(self):
         if self.myCondition.condRep:
             self.myCondition.evaluate('rep')
@@ -748,7 +848,10 @@ class Element(UniqueObject):
 #            if self.myCondition.evaluate('init'):
             if self.init:
                 self.compile()
-            self.doFunc()
+            if self.myCache:
+                self._cachedFunc()
+            else:
+                self.doFunc()
         if self.myCondition.condOut:
             self.myCondition.evaluate('out')
 #            if self.myCondition.evaluate('out'):
@@ -756,6 +859,25 @@ class Element(UniqueObject):
 #            else:
 #                self.active = True
 
+    def _cachedFunc(self):
+        key = self.myCache.key(self.input)
+        pom = self.myCache.get(key)
+        if pom is not None:
+            for i in range(0, len(self.output)):
+                self.output[i]['value'] = pom[i]
+            logging.debug("Element " + self.name + " : outputs taken from the cache")
+        else:
+            self.doFunc()
+            if self.isPending():                                            # cached by resolve()
+                self.cacheKey = key
+            else:
+                self.myCache.put(key, [i['value'] for i in self.output])
+
+    def _cachePending(self):                                                # called by resolve() once the outputs of a pending execution are set
+        if self.myCache and self.cacheKey is not None:
+            self.myCache.put(self.cacheKey, [i['value'] for i in self.output])
+        self.cacheKey = None
+
     def doFunc(self):
         pass
 
@@ -769,6 +891,12 @@ class Element(UniqueObject):
         self.decompile()
         self.compile()
 
+    def isPending(self):                                                # True while the result of the last execution is still being computed (e.g. MATLAB option 'async')
+        return False
+
+    def resolve(self):                                                  # waits for the pending result and writes it to the output pins
+        pass
+
     def _get_type(self,pinID,io):
         if io == 'in' and (len(self.input) >= pinID):
             return self.input[pinID - 1]['type']
@@ -1209,6 +1337,11 @@ class Canvas(Element):
         self.not_my_elem_canvases = []                              # Canvases containing the neighbor elements
         self.start_list = []                                        # contains the starting elements
         self.queueElem = []                                         # contains all the elements that are inside the queue (only unsorted)
+        self.myCache = None                                         # a Canvas is never a pure block; its elements may have caches of their own
+        self.incremental = False                                    # if True, elements are scheduled only if an output they receive has changed
+        if options and 'incremental' in options:
+            self.incremental = options['incremental']
+        self.waiting = []                                           # executed elements with pending results; they are forwarded once resolved
 
 
     def add_element(self, elem):
@@ -1281,14 +1414,22 @@ class Canvas(Element):
             self._add_to_queue(self.start_list[i])
         for i in range(0, len(self.elem_list)):
             self.elem_list[i].compile()
+            if self.incremental:
+                self.elem_list[i].lastOut = None                    # everything is new in a new run
+                self.elem_list[i].changed = None
 
     def decompile(self):
         for i in range(0, len(self.elem_list)):
             self.elem_list[i].decompile()
+            if self.elem_list[i].myCache:
+                self.elem_list[i].myCache.save()
 
     def doFunc(self):
 
+        self._resolve(list(self.waiting))                                   # left over from the previous run
         while True:
+            if self.queue.empty() and self.waiting:                         # results needed inside are resolved now; the rest can overlap with the parent canvas
+                self._resolve([i for i in self.waiting if self.myCanvas is None or any(self._contains(j) for j in self._targets(i))])
             if self.queue.empty():
                 pom = True
                 for i in range(0, len(self.start_list)):
@@ -1298,6 +1439,7 @@ class Canvas(Element):
                         pom = False
                 if pom:
                     break
+                self._resolve(list(self.waiting))                           # the start elements run again
                 # else:
                 #     for i in range(0, len(self.start_list)):
                 #         self._add_to_queue(self.start_list[i])
@@ -1305,14 +1447,7 @@ class Canvas(Element):
             elem = self._get_from_queue()
             #print('Now processing element: ' + elem.name)
             logging.debug('Now processing element: ' + elem.name)
-            elem.execute()
-            if elem.forward():                                                  # this one just copies outputs to the next elements inputs
-                for i in range(0, len(elem.nextElem)):                          # this one puts these next elements into the queue for execution
-                    pom = elem.nextElem[i]
-                    # map the output of elem to the input of nextElem
-                    #(pom[ELEMADDRESS.NEXTELEM]).input[pom[ELEMADDRESS.PININ]-1] = elem.output[pom[ELEMADDRESS.PINOUT]-1]
-                    # add the nextElem to the execution queue
-                    self._add_to_queue(pom[ELEMADDRESS.NEXTELEM])
+            self._process(elem)
 
         for i in range(0, len(self.start_list)):                            # this one is much needed. It is there to initialize for the next start of the canvas (useful for HLA and other components)
             self._add_to_queue(self.start_list[i])
@@ -1320,6 +1455,65 @@ class Canvas(Element):
         #print('exit ' + self.name)
         logging.debug('exit ' + self.name)
 
+    def _process(self, elem):                                               # executes one element taken from the queue; subclasses can override to execute several at once
+        self._resolve([i for i in self.waiting if self._needs(elem, i)])
+        elem.execute()
+        if elem.isPending():                                                # forwarded once its result is needed
+            logging.debug("Element " + elem.name + " is pending in canvas " + self.name)
+            self.waiting.append(elem)
+            return
+        self._forward(elem)
+
+    def isPending(self):
+        return len(self.waiting) > 0
+
+    def resolve(self):
+        self._resolve(list(self.waiting))
+
+    def _resolve(self, elems):
+        for elem in elems:
+            logging.debug("Resolving element " + elem.name + " in canvas " + self.name)
+            self.waiting.remove(elem)
+            elem.resolve()
+            self._forward(elem)
+
+    def _targets(self, elem):                                               # the elements that receive the outputs of a pending element
+        if isinstance(elem, Canvas):
+            pom = []
+            for i in elem.waiting:
+                pom += elem._targets(i)
+            return pom
+        return [i[ELEMADDRESS.NEXTELEM] for i in elem.nextElem]
+
+    def _needs(self, elem, pend):                                           # True if elem has to wait for the result of the pending element pend
+        if elem == pend:
+            return True
+        for i in self._targets(pend):
+            if i == elem or (isinstance(elem, Canvas) and elem._contains(i)):
+                return True
+        return False
+
+    def _contains(self, elem):                                              # True if elem is in this canvas or in one of its sub-canvases
+        if elem in self.elem_list:
+            return True
+        for i in self.elem_list:
+            if isinstance(i, Canvas) and i._contains(elem):
+                return True
+        return False
+
+    def _forward(self, elem):
+        if self.incremental:
+            elem.markChanged()
+        if elem.forward():                                                  # this one just copies outputs to the next elements inputs
+            for i in range(0, len(elem.nextElem)):                          # this one puts these next elements into the queue for execution
+                pom = elem.nextElem[i]
+                if elem.changed is not None and pom[ELEMADDRESS.PINOUT] not in elem.changed:    # nothing new for this element
+                    continue
+                # map the output of elem to the input of nextElem
+                #(pom[ELEMADDRESS.NEXTELEM]).input[pom[ELEMADDRESS.PININ]-1] = elem.output[pom[ELEMADDRESS.PINOUT]-1]
+                # add the nextElem to the execution queue
+                self._add_to_queue(pom[ELEMADDRESS.NEXTELEM])
+
     def start(self):
         self.compile()
         self.execute()
@@ -1676,6 +1870,164 @@ class ForLoop(Canvas):
         self.myCndElem.resetCondition()
         self.myCndElem.setCounterCondition(self.myCnt)
 
+class MultiRateCanvas(Canvas):
+
+    # Time-aware Canvas. The canvas advances its clock from Tstart to Tstop in steps of Tstep and at every
+    # tick executes only the elements that are due. An element is due if it declared a rate with setRate()
+    # and its period elapsed, or if it has no rate and none of its outputs is stamped with a future time.
+    # Elements that are not due are skipped and hold their outputs, so downstream elements keep the last value.
+
+    def __init__(self, name, options):
+        super().__init__(name, options)
+        if 'interval' not in options or 'Tstep' not in options['interval'] or options['interval']['Tstep'] <= 0:
+            raise Exception("MultiRateCanvas.init(): Interval with positive Tstep must be provided.")
+        self.Tstart = 0.0
+        if 'Tstart' in options['interval']:
+            self.Tstart = options['interval']['Tstart']
+        self.Tstep = options['interval']['Tstep']
+        self.Tstop = self.Tstart + self.Tstep
+        if 'Tstop' in options['interval']:
+            self.Tstop = options['interval']['Tstop']
+        self.time = self.Tstart
+
+    def _isDue(self, elem):
+        return elem.nextTime <= self.time + 1.0e-9 * self.Tstep
+
+    def _add_to_queue(self, elem):
+        if elem in self.elem_list and not self._isDue(elem):
+            logging.debug("Element " + elem.name + " is not due at " + str(self.time) + ", holding its outputs")
+            return
+        super()._add_to_queue(elem)
+
+    def _process(self, elem):
+        elem.execute()
+        if elem.isPending():                                               # the outputs are stamped right away, so there is nothing to overlap with
+            elem.resolve()
+        if elem.rate:
+            while self._isDue(elem):
+                elem.nextTime += elem.rate
+            for i in elem.output:
+                i['time'] = self.time
+        else:
+            pom = [i['time'] for i in elem.output if i['time'] > self.time]     # the element told us when it needs to run again
+            if pom:
+                elem.nextTime = min(pom)
+            for i in elem.output:
+                if i['time'] <= self.time:                                  # a later time set by the element itself is kept
+                    i['time'] = self.time
+        self._forward(elem)
+
+    def compile(self):
+        super().compile()
+        self.time = self.Tstart
+        for i in self.elem_list:
+            if i.rate:
+                i.nextTime = self.Tstart + i.rateOffset
+            else:
+                i.nextTime = self.Tstart
+
+    def doFunc(self):
+        n = int(round((self.Tstop - self.Tstart) / self.Tstep))
+        for k in range(0, n):
+            self.time = self.Tstart + k * self.Tstep
+            self.queue = Q.PriorityQueue()
+            self.queueElem = []
+            for i in self.elem_list:
+                if i in self.start_list or i.rate:
+                    self._add_to_queue(i)
+            while not self.queue.empty():                                  # one pass through the due elements per tick
+                elem = self._get_from_queue()
+                logging.debug('Now processing element: ' + elem.name + ' at ' + str(self.time))
+                self._process(elem)
+
+        logging.debug('exit ' + self.name)
+
+
+class EventCanvas(Canvas):
+
+    # Discrete-event Canvas. The queue is a heap ordered by message time, with the element priority as a
+    # tie-breaker. Forwarded messages are delivered to the input pins of the receiver only when their time
+    # comes, and the receiver is executed at that time. Outputs without a time stamp inherit the time of the
+    # event that produced them, so an element that stamps a future time (e.g. TimeToValue) delays its
+    # receivers until then. Elements can also wake themselves with schedule(). Between events nothing is executed.
+
+    def __init__(self, name, options=None):
+        super().__init__(name, options)
+        self.events = []                                                # heap of (time, priority, counter, element)
+        self.pending = {}                                               # (element, time) -> messages to deliver as [pinin, message]
+        self.cnt = 0
+        self.Tstart = 0.0
+        self.Tstop = None
+        if options and 'interval' in options:
+            if 'Tstart' in options['interval']:
+                self.Tstart = options['interval']['Tstart']
+            if 'Tstop' in options['interval']:
+                self.Tstop = options['interval']['Tstop']
+        self.time = self.Tstart
+
+    def _add_to_queue(self, elem, time=None):
+        if elem not in self.elem_list:                                  # neighbors belong to other canvases
+            super()._add_to_queue(elem)
+            return
+        if time is None:
+            time = self.time
+        if (elem, time) in self.pending:
+            return
+        logging.debug("Scheduling element " + elem.name + " at " + str(time) + " in canvas " + self.name)
+        heapq.heappush(self.events, (time, elem.priority, self.cnt, elem))
+        self.pending[(elem, time)] = []
+        self.cnt += 1
+
+    def schedule(self, elem, time):
+        self._add_to_queue(elem, time)
+
+    def _process(self, elem):
+        elem.execute()
+        if elem.isPending():
+            elem.resolve()
+        for i in elem.output:
+            if i['time'] < self.time:
+                i['time'] = self.time
+        self._forward(elem)
+
+    def _forward(self, elem):
+        if not elem.active:
+            return
+        for pinout, nxt, pinin in elem.nextElem:
+            if len(nxt.input) == 0 or len(elem.output) == 0:
+                continue
+            msg = copy.deepcopy(elem.output[pinout - 1])
+            if nxt in self.elem_list:
+                time = max(msg['time'], self.time)
+                self._add_to_queue(nxt, time)
+                self.pending[(nxt, time)].append([pinin, msg])
+            else:
+                copyMachine.copyAll(nxt.input[pinin - 1], msg)
+                self._add_to_queue(nxt)
+
+    def compile(self):
+        self.events = []
+        self.pending = {}
+        self.time = self.Tstart
+        super().compile()
+
+    def doFunc(self):
+        while self.events:
+            if self.Tstop is not None and self.events[0][0] > self.Tstop:
+                break
+            time, priority, cnt, elem = heapq.heappop(self.events)
+            for pinin, msg in self.pending.pop((elem, time)):
+                copyMachine.copyAll(elem.input[pinin - 1], msg)
+            self.time = time
+            logging.debug('Now processing element: ' + elem.name + ' at ' + str(self.time))
+            self._process(elem)
+
+        for i in range(0, len(self.start_list)):
+            self._add_to_queue(self.start_list[i])
+
+        logging.debug('exit ' + self.name)
+
+
 class GenericElement(Element):
 
     def __init__(self,name,Nin,Nout,func=None,type=VALUETYPES.DEFAULT,options=None):
@@ -17,6 +17,8 @@
 
 
 
+import logging
+
 from fmpy import read_model_description, extract, dump
 from fmpy.fmi1 import *
 from fmpy.fmi2 import *
@@ -24,8 +26,11 @@ from fmpy.util import plot_result, download_test_file, auto_interval
 import shutil
 from fmpy.simulation import Recorder, apply_start_values
 from fmpy.simulation import Input as FMPYinput
-from fmpy import simulate_fmu
 import numpy
+from concurrent.futures import ThreadPoolExecutor
+import multiprocessing
+import os
+import inspect
 
 
 
@@ -46,9 +51,22 @@ AUTOMVAR = 10
 
 
 
+class _SolverInput(object):
+
+    # handed to CVodeSolver of fmpy versions that apply the input themselves; it always applies the current
+    # self.inEvent of the FMPY block, which is replaced when the input signals change
+
+    def __init__(self, elem):
+        self.myElem = elem
+
+    def apply(self, *args, **kwargs):
+        return self.myElem.inEvent.apply(*args, **kwargs)
+
+
+
 class FMPY(Element):
 
-    def __init__(self,name,options):
+    def __init__(self,name,options,modelDescription=None):           # modelDescription can be passed if it has already been read
         super().__init__(name,options)
 #        self.createFlexInputPin()
 #        self.createPin('out', VALUETYPES.REAL)
@@ -73,6 +91,35 @@ class FMPY(Element):
         else:
             Exception('Error! FMPY.init(): Unsupported value for "dyn".')
 
+        self.batch = 0                                                      # number of communication steps advanced in one doFunc (0 means one step per token)
+        self.batchHold = "const"
+        if 'batch' in options:
+            if options['dyn'] != "step" or options['type'] != "CS":
+                raise Exception('Error! FMPY.init(): "batch" is only supported with dyn="step" and type="CS".')
+            self.batch = options['batch']['steps']
+            if 'hold' in options['batch']:
+                self.batchHold = options['batch']['hold']           # "const" holds the inputs for the entire batch, "series" takes one input sample per step
+            if self.batchHold != "const" and self.batchHold != "series":
+                raise Exception('Error! FMPY.init(): Batch input "hold" can either be "const" or "series".')
+            self.outType = VALUETYPES.VECTOR                        # every output carries one value per communication step of the batch
+
+        self.signals = []                                                   # inputs that carry an entire signal, interpolated by self.inEvent at every step
+        self.signalTime = None                                              # time points of the signal samples (default Tstart, Tstart+Tstep, ...)
+        if 'signals' in options:
+            if options['dyn'] != "step":
+                raise Exception('Error! FMPY.init(): "signals" are only supported with dyn="step".')
+            for i in options['signals']:
+                if i not in options['inputs']:
+                    raise Exception('Error! FMPY.init(): Signal ' + i + ' must be one of the inputs.')
+            self.signals = options['signals']
+            if 'signalTime' in options:
+                self.signalTime = numpy.asarray(options['signalTime'], dtype=numpy.float64)
+        self.signalValues = None                                            # the signals self.inEvent was built from
+
+        self.fullIn = None                                                  # dyn="full": structured input array, its fmpy Input and the result buffer, reused between runs
+        self.fullEvent = None
+        self.fullOut = None
+
         if 'fmu' in options:
             self.myFMUid = options['fmu']
         else:
@@ -104,22 +151,26 @@ class FMPY(Element):
         else:
             Exception('Interval for dynamic simulation must be specified.')
 
+        self.Timeout = 100
+        self.Tolerance = 1e-06
         if 'solOpt' in options:
-            if 'Timeout' in options['interval']:
+            if 'Timeout' in options['solOpt']:
+                self.Timeout = options['solOpt']['Timeout']
+            elif 'Timeout' in options['interval']:
                 self.Timeout = options['interval']['Timeout']
-            else:
-                self.Timeout = 100
-            if 'Tolerance' in options['interval']:
+            if 'Tolerance' in options['solOpt']:
+                self.Tolerance = options['solOpt']['Tolerance']
+            elif 'Tolerance' in options['interval']:
                 self.Tolerance = options['interval']['Tolerance']
-            else:
-                self.Tolerance = 1e-06
 
         self.t_next = self.Tstart
 
         self.FMUinput = []
         self.FMUoutput = []
 
-        self.modelDescription = read_model_description(self.myFMUid, validate=True)
+        if modelDescription is None:
+            modelDescription = read_model_description(self.myFMUid, validate=True)
+        self.modelDescription = modelDescription
         self.unzipdir = extract(self.myFMUid)                                  # is this one needed or I can delete it
 
         logger = printLogMessage
@@ -145,22 +196,37 @@ class FMPY(Element):
 
 #        tIPSL = IPSLtranslator(self.modelDescription.modelVariables)
 
-        self.FMUoutput = []
-        for i in self.options['outputs']:
-            self.FMUoutput.append(self.vrs[i])
-            self.createPin('out', self.outType, i)
-
-        self.FMUinput = []
-        for i in self.options['inputs']:
-            self.FMUinput.append(self.vrs[i])
-            self.createPin('in', self.inType, i)
-
-        self.FMUinit = []
-        for i in self.options['x0']:
-            self.FMUinit.append(self.vrs[i])
-            self.createPin('in', self.inType, i, "init")
-            self.setInputCondition("edge{"+i+"}",'init')
-
+        self._createPins()
+
+        self.recResult = None                                               # preallocated samples x (1 + variables) array of the built-in recorder (see _record)
+        if 'record' in options:
+            rec = options['record']
+            if 'variables' in rec:
+                self.recVars = list(rec['variables'])
+                for i in self.recVars:
+                    if i not in self.vrs:
+                        raise Exception('Error! FMPY.init(): Recorded variable ' + i + ' is not a variable of the FMU.')
+            else:                                                           # the FMU variables behind the output pins, also when the outputs are translated
+                names = {}
+                for i in self.modelDescription.modelVariables:
+                    if i.valueReference not in names:
+                        names[i.valueReference] = i.name
+                self.recVars = []
+                for i in self.FMUoutput:
+                    if names[i] not in self.recVars:
+                        self.recVars.append(names[i])
+            self.recRefs = [self.vrs[i] for i in self.recVars]
+            self.recHeader = ['time'] + self.recVars                        # the columns of the recorded array
+            self.recInterval = self.Tstep                                   # sampling interval, 'decimation' records every n-th communication step
+            if 'interval' in rec:
+                self.recInterval = rec['interval']
+            elif 'decimation' in rec:
+                self.recInterval = rec['decimation'] * self.Tstep
+            self.recResult = numpy.empty((int(round((self.Tstop - self.Tstart) / self.recInterval)) + 1, len(self.recHeader)), dtype=numpy.float64)
+            self.recCount = 0
+            self.recNext = self.Tstart
+            self.recPin = len(self.output)
+            self.createPin('out', VALUETYPES.MATRIX, 'result')             # the recorded points, one row per sample with the columns of recHeader
 
         if options['type'] == 'CS':
             if options['fmu_ver'] == 1:
@@ -206,17 +272,74 @@ class FMPY(Element):
             else:
                 self.fixed_step = False
 
+            # the solver is created on the first compile and re-initialized with reset() by the later compiles of the
+            # same run (e.g. every ForLoop iteration); decompile() frees the FMU instance and drops the solver with it
+            self.solver = None
+            self.solverOpt = {'maxStep': (self.Tstop - self.Tstart) / 50., 'relTol': 0.001, 'maxNumSteps': 500000}
+            for i in self.solverOpt:
+                if i in options['solOpt']:
+                    self.solverOpt[i] = options['solOpt'][i]
+
+        self.adapt = None                                                   # adaptive communication step size (CS only)
+        if 'adapt' in options:
+            if options['type'] != 'CS' or options['fmu_ver'] != 2:
+                raise Exception('Error! FMPY.init(): "adapt" is only supported for FMU for co-simulation version 2.')
+            if not self.modelDescription.coSimulation.canHandleVariableCommunicationStepSize:
+                raise Exception('Error! FMPY.init(): The FMU cannot handle a variable communication step size.')
+            self.adapt = {'Tmin': self.Tstep / 100., 'Tmax': self.Tstep * 100., 'rtol': 1e-03, 'atol': 1e-06, 'grow': 2.0, 'shrink': 0.5}
+            self.adapt.update(options['adapt'])
+            self.canRollback = bool(self.modelDescription.coSimulation.canGetAndSetFMUstate)
+            self.canDerive = self.modelDescription.coSimulation.maxOutputDerivativeOrder is not None and \
+                             self.modelDescription.coSimulation.maxOutputDerivativeOrder >= 1
+            if not self.canRollback and not self.canDerive:
+                raise Exception('Error! FMPY.init(): "adapt" needs an FMU that can get and set its state or provides output derivatives to estimate the step error.')
+            self.h = self.Tstep
+            self.lastU = None
+
         self.inEvent = FMPYinput(self.myFMU, self.modelDescription, None)
 
 
+    def _createPins(self):
+        self.FMUoutput = []
+        for i in self.options['outputs']:
+            self.FMUoutput.append(self.vrs[i])
+            self.createPin('out', self.outType, i)
+
+        self.FMUinput = []
+        for i in self.options['inputs']:
+            self.FMUinput.append(self.vrs[i])
+            if i in self.signals:
+                self.createPin('in', VALUETYPES.VECTOR, i)
+            elif self.batch and self.batchHold == "series":
+                self.createPin('in', VALUETYPES.VECTOR, i)
+            else:
+                self.createPin('in', self.inType, i)
+
+        self.FMUinit = []
+        for i in self.options['x0']:
+            self.FMUinit.append(self.vrs[i])
+            self.createPin('in', self.inType, i, "init")
+            self.setInputCondition("edge{"+i+"}",'init')
+
+
     def doFunc(self):
 
+        if self.batch:
+            self._doBatch()
+            return
+
+        if self.options['dyn'] == 'full':       #TODO: probably need to change all self.options['inputs'] into combination of self.options['inputs'] and self.options['x0']
+            self._doFull()
+            return
+
         inputValues = []
         FMUinputRefs = []
         if self.inType == VALUETYPES.REAL:
 #            for i in range(0, len(self.input)):
 #                if self.options['inmask'][i] == 0:  # The mask vector is used to separate initialization inputs (inmask=1) from regular causality="input" (inmask=0)
             for i in range(0, len(self.options['inputs'])):
+                if self.options['inputs'][i] in self.signals:
+                    continue
                 inputValues.append(self.input[i]['value'])
                 FMUinputRefs.append(self.FMUinput[i])
 
@@ -224,156 +347,385 @@ class FMPY(Element):
             print("This function is not supported yet!") # figure out how to initialize fmu when the entire input vector is given
 
         self.myFMU.setReal(list(FMUinputRefs), list(inputValues))
+        self._updateSignals()
 #        self.myFMU.setReal(list(self.FMUinput), list(inputValues))
 
 
-        if self.options['dyn'] == 'full':       #TODO: probably need to change all self.options['inputs'] into combination of self.options['inputs'] and self.options['x0']
+        if self.options['dyn'] == 'step':
 
-            # setup the numpy format for specifying input variables
-            dt = [('time', np.float64)]
-            dt += zip(self.options['inputs'], [np.float64] * len(self.options['inputs']))
+            if self.options['type'] == 'CS':
+                if self.adapt:
+                    self._stepAdaptive(inputValues)
+                else:
+                    self._stepCS()
+            elif self.options['type'] == 'ME':
+                self._stepME()
+            else:
+                Exception("Please provide either 'ME' or 'CS' type.")
 
-            # print the numpy format for specifying input variables just to make sure it's ok
-            print(dt)
+            pom = self.myFMU.getReal(list(self.FMUoutput))
+            for i in range(0, len(self.FMUoutput)):
+                self.output[i]['value'] = pom[i]
+                if self.adapt:
+                    self.output[i]['time'] = self.time              # with a variable step the receivers need to know where the FMU is
 
-            # assign the input to input variables
-        #    pom = numpy.empty(len(inputValues),dtype=dt)
-            if self.options['type']=="ME":
-                pom = numpy.empty(2, dtype=dt)                          # with ME it is necessary to assign first step value and last step value
-                pom['time'] = [self.Tstart, self.Tstop]
-            elif self.options['type']=='CS':
-                pom = numpy.empty(1, dtype=dt)                          # with CS it is necessary just to assign one value for the entire period
-                pom['time'] = self.Tstart
+            self._record()
+            logging.debug("FMPY element " + self.name + " : " + str(pom))
+        else:
+            Exception("Simulation option 'dyn' can be either 'step' or 'full'.")
 
-            for i in range(0,len(self.options['inputs'])):
-                pom[self.options['inputs'][i]] = inputValues[i]         # assign all input values, time has been assigned previously
 
+    def _record(self):
+        # adds a sample to the recorder whenever the next sampling time has been reached; the buffer is sized
+        # for [Tstart, Tstop] and doubled if the run goes on, and the output pin holds a view of the samples so far
+
+        if self.recResult is None:
+            return
+        eps = 1.0e-13
+        if self.time < self.recNext - eps:
+            return
+        if self.recCount == len(self.recResult):
+            self.recResult = numpy.concatenate((self.recResult, numpy.empty(self.recResult.shape, dtype=self.recResult.dtype)))
+        self.recResult[self.recCount, 0] = self.time
+        self.recResult[self.recCount, 1:] = self.myFMU.getReal(self.recRefs)
+        self.recCount += 1
+        self.recNext = self.Tstart + (numpy.floor((self.time - self.Tstart + eps) / self.recInterval) + 1) * self.recInterval
+        self.output[self.recPin]['value'] = self.recResult[:self.recCount]
+
+
+    def _updateSignals(self):
+        # (re)builds the fmpy Input from the signal inputs, but only when one of the signals has changed;
+        # a signal holds its last sample if it is shorter than the time points
+
+        if not self.signals:
+            return
+        values = []
+        for i in range(0, len(self.options['inputs'])):
+            if self.options['inputs'][i] in self.signals:
+                values.append(self.input[i]['value'])
+        if self.signalValues is not None:
+            changed = False
+            for new, old in zip(values, self.signalValues):
+                if new is not old and not numpy.array_equal(new, old):
+                    changed = True
+                    break
+            if not changed:
+                return
+        self.signalValues = values
+
+        if self.signalTime is not None:
+            t = self.signalTime
+        else:
+            n = max(len(i) for i in values)
+            t = self.Tstart + numpy.arange(n) * self.Tstep
+
+        dt = [('time', numpy.float64)]
+        dt += zip(self.signals, [numpy.float64] * len(self.signals))
+        signals = numpy.empty(len(t), dtype=dt)
+        signals['time'] = t
+        for name, pom in zip(self.signals, values):
+            pom = numpy.asarray(pom, dtype=numpy.float64)
+            k = min(len(pom), len(t))
+            signals[name][:k] = pom[:k]
+            signals[name][k:] = pom[k-1]
+        self.inEvent = FMPYinput(self.myFMU, self.modelDescription, signals)
+        logging.debug("FMPY element " + self.name + " : input signals updated")
+
+
+    def _stepCS(self):
+        time = self.time
+        step = self.Tstep
+        if self.options['dyn'] == 'full' and time + step > self.Tstop:
+            step = self.Tstop - time                                    # do not integrate past the end of the interval
+        self.inEvent.apply(time)
+        self.myFMU.doStep(currentCommunicationPoint=time, communicationStepSize=step)
+        self.time += step
+
+
+    def _stepAdaptive(self, inputValues):
+        # one communication step of variable size self.h, controlled by an estimate of the local error of the outputs:
+        # if the FMU can get and set its state, by step doubling (one step of h against two steps of h/2 from the saved
+        # state; the two half steps are kept and a step above the tolerance is repeated with a smaller h), otherwise
+        # from the output derivatives (the deviation from the linear prediction y0 + h*dy0, which can only adjust the
+        # next step). Large changes of the inputs and discarded doSteps shrink the step as well
+
+        a = self.adapt
+        time = self.time
+
+        if self.lastU is not None:
+            du = 0.0
+            for u, u0 in zip(inputValues, self.lastU):
+                du = max(du, abs(u - u0) / (a['atol'] + a['rtol'] * abs(u0)))
+            if du > 1.0:
+                self.h = max(self.h * a['shrink'], a['Tmin'])
+        self.lastU = list(inputValues)
+
+        state = None
+        if self.canRollback:
+            state = self.myFMU.getFMUstate()
+        else:
+            y0 = self.myFMU.getReal(list(self.FMUoutput))
+            dy0 = self.myFMU.getRealOutputDerivatives(list(self.FMUoutput), [1] * len(self.FMUoutput))
+
+        while True:
+            h = self.h
+            if self.options['dyn'] == 'full' and time + h > self.Tstop:
+                h = self.Tstop - time
+
+            err = 0.0
+            discard = self._tryStep(time, h)
+            if not discard and state is not None:
+                yFull = self.myFMU.getReal(list(self.FMUoutput))
+                self.myFMU.setFMUstate(state)
+                discard = self._tryStep(time, h / 2.) or self._tryStep(time + h / 2., h / 2.)
+                if not discard:
+                    yHalf = self.myFMU.getReal(list(self.FMUoutput))
+                    for i in range(0, len(yHalf)):
+                        err = max(err, abs(yHalf[i] - yFull[i]) / (a['atol'] + a['rtol'] * max(abs(yFull[i]), abs(yHalf[i]))))
+            elif not discard:
+                y1 = self.myFMU.getReal(list(self.FMUoutput))
+                for i in range(0, len(y1)):
+                    err = max(err, abs(y1[i] - y0[i] - h * dy0[i]) / (a['atol'] + a['rtol'] * max(abs(y0[i]), abs(y1[i]))))
+
+            if (discard or err > 1.0) and state is not None and h > a['Tmin']:
+                self.myFMU.setFMUstate(state)
+                self.h = max(h * a['shrink'], a['Tmin'])
+                logging.debug("FMPY element " + self.name + " : step rejected at " + str(time) + ", retrying with " + str(self.h))
+                continue
+
+            if discard:
+                logging.warning("FMPY element " + self.name + " : doStep discarded at " + str(time) + " and cannot be repeated.")
+                self.h = max(h * a['shrink'], a['Tmin'])
+            elif err < 1.0 / a['grow']:
+                self.h = min(h * a['grow'], a['Tmax'])
+            elif err > 1.0:
+                self.h = max(h * a['shrink'], a['Tmin'])
+            break
+
+        if state is not None:
+            self.myFMU.freeFMUstate(state)
+
+        self.time += h
+
+
+    def _tryStep(self, time, h):                                        # one doStep; True if the FMU discarded it
+        self.inEvent.apply(time)
+        try:
+            return self.myFMU.doStep(currentCommunicationPoint=time, communicationStepSize=h) == fmi2Discard
+        except Exception as e:
+            if getattr(e, 'status', None) != fmi2Discard:               # newer fmpy raises on status > fmi2Warning
+                raise
+            return True
+
+
+    def _stepME(self):
+        time = self.time
+        eps = 1.0e-13
+        # step ahead in time
+        if self.fixed_step:
+            if time + self.Tstep < self.Tstop + eps:
+                self.t_next = time + self.Tstep
+                #            else:
+                #                break
+        else:
+            if time + eps >= self.t_next:  # t_next has been reached
+                # integrate to the next grid point
+                self.t_next = round(time / self.Tstep) * self.Tstep + self.Tstep
 
-            print(pom)
-            inputValues = pom
+        # gets the time of input event
+        t_input_event = self.inEvent.apply(time)
 
-            result = simulate_fmu(self.options['fmu'],
-                                  start_time=self.Tstart,
-                                  stop_time=self.Tstop,
-                                  timeout=self.Timeout,
-                                  step_size=self.Tstep,
-                                  input=inputValues,
-                                  output=self.options['outputs'])
-            print("result of simulate_fmu is "+str(result))
-            print("dtype is "+str(result.dtype))
+        # check for input event
+        input_event = t_input_event <= self.t_next
 
-            for i in range (0,len(self.options['outputs'])):
-                pom = result[self.options['outputs'][i]]
-                print(pom)
-                if self.outType==VALUETYPES.REAL:
-                    self.output[i]['value'] = pom[-1]
-                elif self.outType==VALUETYPES.VECTOR:
-                    self.output[i]['value'] = pom
+        if input_event:
+            self.t_next = t_input_event
 
+        # check the time of next event.
+        time_event = None
+        if self.options['fmu_ver'] == 1:
+            time_event = self.myFMU.eventInfo.upcomingTimeEvent != fmi1False and self.myFMU.eventInfo.nextEventTime <= self.t_next
+        elif self.options['fmu_ver'] == 2:
+            time_event = self.myFMU.eventInfo.nextEventTimeDefined != fmi2False and self.myFMU.eventInfo.nextEventTime <= self.t_next
+        else:
+            Exception("Please provide an existing FMU version")
 
 
-        elif self.options['dyn'] == 'step':
+        if time_event and not self.fixed_step:
+            self.t_next = self.myFMU.eventInfo.nextEventTime
 
-            time = self.time
-            if self.options['type'] == 'CS':
-                self.inEvent.apply(time)
-                self.myFMU.doStep(currentCommunicationPoint=time, communicationStepSize=self.Tstep)
-                self.time +=self.Tstep
-            elif self.options['type'] == 'ME':
-                eps = 1.0e-13
-                # step ahead in time
-                if self.fixed_step:
-                    if time + self.Tstep < self.Tstop + eps:
-                        self.t_next = time + self.Tstep
-                        #            else:
-                        #                break
-                else:
-                    if time + eps >= self.t_next:  # t_next has been reached
-                        # integrate to the next grid point
-                        self.t_next = round(time / self.Tstep) * self.Tstep + self.Tstep
+        state_event = None
+        if self.t_next - time > eps:
+            # do one step
+            state_event, time = self.solver.step(time, self.t_next)
+        else:
+            # skip
+            time = self.t_next
+
+        # set the time
+        self.myFMU.setTime(time)
+
+        # check for step event, e.g.dynamic state selection
+        step_event = None
+        if self.options['fmu_ver'] == 1:
+            step_event = self.myFMU.completedIntegratorStep()
+        elif self.options['fmu_ver'] == 2:
+            step_event, _ = self.myFMU.completedIntegratorStep()
+            step_event = step_event != fmi2False
+        else:
+            Exception("Please provide an existing FMU version")
 
-                # gets the time of input event
-                t_input_event = self.inEvent.apply(time)
+        # handle events
+        if input_event or time_event or state_event or step_event:
 
-                # check for input event
-                input_event = t_input_event <= self.t_next
+            # recorder.sample(time, force=True)
 
-                if input_event:
-                    self.t_next = t_input_event
+            if input_event:
+                self.inEvent.apply(time=time, after_event=True)
 
-                # check the time of next event.
-                time_event = None
-                if self.options['fmu_ver'] == 1:
-                    time_event = self.myFMU.eventInfo.upcomingTimeEvent != fmi1False and self.myFMU.eventInfo.nextEventTime <= self.t_next
-                elif self.options['fmu_ver'] == 2:
-                    time_event = self.myFMU.eventInfo.nextEventTimeDefined != fmi2False and self.myFMU.eventInfo.nextEventTime <= self.t_next
-                else:
-                    Exception("Please provide an existing FMU version")
+            # handle events
+            if self.options['fmu_ver'] == 1:
+                self.myFMU.eventUpdate()
+            elif self.options['fmu_ver'] == 2:
+                # handle events
+                self.myFMU.enterEventMode()
 
+                self.myFMU.eventInfo.newDiscreteStatesNeeded = fmi2True
+                self.myFMU.eventInfo.terminateSimulation = fmi2False
 
-                if time_event and not self.fixed_step:
-                    self.t_next = self.myFMU.eventInfo.nextEventTime
+                # update discrete states
+                while self.myFMU.eventInfo.newDiscreteStatesNeeded != fmi2False and self.myFMU.eventInfo.terminateSimulation == fmi2False:
+                    self.myFMU.newDiscreteStates()
 
-                state_event = None
-                if self.t_next - time > eps:
-                    # do one step
-                    state_event, time = self.solver.step(time, self.t_next)
-                else:
-                    # skip
-                    time = self.t_next
-
-                # set the time
-                self.myFMU.setTime(time)
-
-                # check for step event, e.g.dynamic state selection
-                step_event = None
-                if self.options['fmu_ver'] == 1:
-                    step_event = self.myFMU.completedIntegratorStep()
-                elif self.options['fmu_ver'] == 2:
-                    step_event, _ = self.myFMU.completedIntegratorStep()
-                    step_event = step_event != fmi2False
-                else:
-                    Exception("Please provide an existing FMU version")
+                self.myFMU.enterContinuousTimeMode()
+            else:
+                Exception("Please provide an existing FMU version")
 
-                # handle events
-                if input_event or time_event or state_event or step_event:
+            self.solver.reset(time)
+
+        self.time = time
+
+
+    def _doFull(self):
+        # simulates the entire interval [Tstart, Tstop] on the FMU instance held by this element,
+        # without re-reading and re-instantiating the FMU as fmpy.simulate_fmu does
 
-                    # recorder.sample(time, force=True)
+        if self.time > self.Tstart:                                     # the instance has already been run, bring it back to Tstart
+            self._restart()
+
+        # assign the input to input variables
+        if len(self.options['inputs']) > 0:
+            if self.inType == VALUETYPES.VECTOR:                        # one input value per Tstep, i.e. vectors of size (Tstop-Tstart)/Tstep+1
+                n = len(self.input[0]['value'])
+            elif self.options['type'] == "ME":
+                n = 2                                                   # with ME it is necessary to assign first step value and last step value
+            else:
+                n = 0                                                   # with CS one value holds for the entire period and is simply set
+            if n == 0:
+                inputValues = []
+                for i in range(0, len(self.options['inputs'])):
+                    inputValues.append(self.input[i]['value'])
+                self.myFMU.setReal(list(self.FMUinput), inputValues)
+            else:
+                if self.fullIn is None or len(self.fullIn) != n:
+                    self._fullInputs(n)
+                changed = self.fullEvent is None
+                for i in range(0, len(self.options['inputs'])):
+                    pom = self.fullIn[self.options['inputs'][i]]
+                    if changed or not numpy.all(pom == self.input[i]['value']):
+                        pom[:] = self.input[i]['value']                 # updated in place, time has been assigned at allocation
+                        changed = True
+                if changed:                                             # the fmpy Input copies the signals, so it is kept while they do not change
+                    self.fullEvent = FMPYinput(self.myFMU, self.modelDescription, self.fullIn)
+                self.inEvent = self.fullEvent
+
+        result = self.fullOut
+        nOut = len(result)
+        eps = 1.0e-13
+        result[0] = (self.time,) + tuple(self.myFMU.getReal(list(self.FMUoutput)))
+        k = 1
+        while self.time < self.Tstop - eps:
+            if self.options['type'] == 'CS':
+                self._stepCS()
+            elif self.options['type'] == 'ME':
+                self._stepME()
+            else:
+                Exception("Please provide either 'ME' or 'CS' type.")
+                return
+            if k < nOut and self.time >= self.Tstart + k * self.Toutput - eps:
+                result[k] = (self.time,) + tuple(self.myFMU.getReal(list(self.FMUoutput)))
+                k += 1
+            self._record()
+
+        for i in range(0, len(self.options['outputs'])):
+            pom = result[self.options['outputs'][i]]
+            if self.outType == VALUETYPES.REAL:
+                self.output[i]['value'] = pom[k-1]
+            elif self.outType == VALUETYPES.VECTOR:
+                self.output[i]['value'] = pom[:k].copy()                # the buffer is overwritten by the next run
+
+        logging.debug("FMPY element " + self.name + " : simulated " + str(k) + " output points until " + str(self.time))
+
+
+    def _fullInputs(self, n):
+        # allocates the structured input array of dyn="full" for n samples per input
+        dt = [('time', numpy.float64)]
+        dt += zip(self.options['inputs'], [numpy.float64] * len(self.options['inputs']))
+        self.fullIn = numpy.zeros(n, dtype=dt)
+        if self.inType == VALUETYPES.VECTOR:
+            self.fullIn['time'] = self.Tstart + numpy.arange(n) * self.Tstep
+        else:
+            self.fullIn['time'] = [self.Tstart, self.Tstop]
+        self.fullEvent = None
 
-                    if input_event:
-                        self.inEvent.apply(time=time, after_event=True)
 
-                    # handle events
-                    if self.options['fmu_ver'] == 1:
-                        self.myFMU.eventUpdate()
-                    elif self.options['fmu_ver'] == 2:
-                        # handle events
-                        self.myFMU.enterEventMode()
+    def _doBatch(self):
+        # advances self.batch communication steps within a single token; the inputs are either held for the
+        # entire batch or taken sample by sample from the input vectors (e.g. a TXBuffer or a VECTOR Source)
 
-                        self.myFMU.eventInfo.newDiscreteStatesNeeded = fmi2True
-                        self.myFMU.eventInfo.terminateSimulation = fmi2False
+        outputValues = []
+        for i in range(0, len(self.FMUoutput)):
+            outputValues.append([])
 
-                        # update discrete states
-                        while self.myFMU.eventInfo.newDiscreteStatesNeeded != fmi2False and self.myFMU.eventInfo.terminateSimulation == fmi2False:
-                            self.myFMU.newDiscreteStates()
+        FMUinputRefs = []
+        for i in range(0, len(self.options['inputs'])):
+            if self.options['inputs'][i] not in self.signals:
+                FMUinputRefs.append(self.FMUinput[i])
+        self._updateSignals()
 
-                        self.myFMU.enterContinuousTimeMode()
+        if self.batchHold == "const":
+            inputValues = []
+            for i in range(0, len(self.options['inputs'])):
+                if self.options['inputs'][i] not in self.signals:
+                    inputValues.append(self.input[i]['value'])
+            self.myFMU.setReal(FMUinputRefs, inputValues)
+
+        for k in range(0, self.batch):
+            if self.batchHold == "series":
+                inputValues = []
+                for i in range(0, len(self.options['inputs'])):
+                    if self.options['inputs'][i] in self.signals:
+                        continue
+                    pom = self.input[i]['value']
+                    if k < len(pom):
+                        inputValues.append(pom[k])
                     else:
-                        Exception("Please provide an existing FMU version")
+                        inputValues.append(pom[-1])                 # the last sample is held if the series is shorter than the batch
+                self.myFMU.setReal(FMUinputRefs, inputValues)
 
-                    self.solver.reset(time)
-            else:
-                Exception("Please provide either 'ME' or 'CS' type.")
+            self.inEvent.apply(self.time)
+            self.myFMU.doStep(currentCommunicationPoint=self.time, communicationStepSize=self.Tstep)
+            self.time += self.Tstep
 
             pom = self.myFMU.getReal(list(self.FMUoutput))
             for i in range(0, len(self.FMUoutput)):
-                self.output[i]['value'] = pom[i]
-
-            print(pom)
-        else:
-            Exception("Simulation option 'dyn' can be either 'step' or 'full'.")
+                outputValues[i].append(pom[i])
+            self._record()
 
+        for i in range(0, len(self.FMUoutput)):
+            self.output[i]['value'] = outputValues[i]
 
+        logging.debug("FMPY element " + self.name + " : batch of " + str(self.batch) + " steps finished at " + str(self.time))
 
 
     def compile(self):
@@ -398,9 +750,32 @@ class FMPY(Element):
         if self.firstRun<0:
             self.firstRun = 0
 
+        self.signalValues = None                                            # the fmpy Input is rebuilt on the next step
+
+        if self.options['dyn'] == 'full' and self.fullOut is None:         # the result buffer is allocated once and reused by every run
+            if 'Toutput' in self.options['interval']:
+                self.Toutput = self.options['interval']['Toutput']
+            else:
+                self.Toutput = self.Tstep
+            rt = [('time', numpy.float64)]
+            rt += zip(self.options['outputs'], [numpy.float64] * len(self.options['outputs']))
+            self.fullOut = numpy.empty(int(round((self.Tstop - self.Tstart) / self.Toutput)) + 1, dtype=rt)
+            if self.inType != VALUETYPES.VECTOR and self.options['type'] == 'ME':
+                self._fullInputs(2)
+
+        self._restart()
+
+
+    def _restart(self):
+        # brings the FMU instance back to Tstart and (re)initializes it
+
         self.time = self.Tstart
         self.t_next = self.Tstart
+        if self.adapt:
+            self.h = self.Tstep
+            self.lastU = None
         self.myFMU.reset()
+        self._startValues()
 
         if self.options['type'] == 'CS':
             if self.options['fmu_ver'] == 1:
@@ -433,34 +808,292 @@ class FMPY(Element):
             else:
                 Exception("Please provide an existing FMU version")
 
-            solver_args = {
-                'nx': self.modelDescription.numberOfContinuousStates,
-                'nz': self.modelDescription.numberOfEventIndicators,
-                'get_x': self.myFMU.getContinuousStates,
-                'set_x': self.myFMU.setContinuousStates,
-                'get_dx': self.myFMU.getDerivatives,
-                'get_z': self.myFMU.getEventIndicators
-            }
-
             if 'solver' in self.options['solOpt']:
                 if self.options['solOpt']['solver'] == 'CVODE':
-                    from fmpy.sundials import CVodeSolver
-                    self.solver = CVodeSolver(set_time=self.myFMU.setTime,
-                                          startTime=self.Tstart,
-                                          maxStep=(self.Tstop - self.Tstart) / 50.,
-                                          relativeTolerance=0.001,
-                                          **solver_args)
+                    if self.solver is None:
+                        solver_args = {
+                            'nx': self.modelDescription.numberOfContinuousStates,
+                            'nz': self.modelDescription.numberOfEventIndicators,
+                            'get_x': self.myFMU.getContinuousStates,
+                            'set_x': self.myFMU.setContinuousStates,
+                            'get_dx': self.myFMU.getDerivatives,
+                            'get_z': self.myFMU.getEventIndicators
+                        }
+                        from fmpy.sundials import CVodeSolver
+                        params = inspect.signature(CVodeSolver).parameters  # the arguments differ between fmpy versions
+                        if self.options['fmu_ver'] == 2 and 'get_nominals' in params:
+                            solver_args['get_nominals'] = self.myFMU.getNominalsOfContinuousStates     # scales the absolute tolerances of the states
+                        if 'input' in params:
+                            solver_args['input'] = _SolverInput(self)
+                        self.solver = CVodeSolver(set_time=self.myFMU.setTime,
+                                              startTime=self.Tstart,
+                                              maxStep=self.solverOpt['maxStep'],
+                                              relativeTolerance=self.solverOpt['relTol'],
+                                              maxNumSteps=self.solverOpt['maxNumSteps'],
+                                              **solver_args)
+                    else:
+                        self.solver.reset(self.Tstart)                  # re-initializes CVODE from the current states of the FMU
 
         else:
             Exception("Please provide either 'ME' or 'CS' type.")
 
+        if self.recResult is not None:                                      # the recording starts over from the initial point
+            self.recCount = 0
+            self.recNext = self.Tstart
+            self._record()
+
+
+    def _startValues(self):                                             # start values set here are not undone by the reset of the instance
+        pass
+
 
     def decompile(self):
         self.firstRun = 1
         self.myFMU.terminate()
         self.myFMU.freeInstance()
         if self.options['type'] == 'ME':
-            del self.solver
+            self.solver = None                                          # the solver holds callbacks into the freed instance, so it does not outlive the run
         shutil.rmtree(self.unzipdir)
 
 
+
+class FMPYGroup(Canvas):
+
+    # Coordinated stepping of several FMPY blocks. All FMPY blocks of this canvas that are queued at the same
+    # communication point are executed concurrently on a thread pool (doStep runs in native code and releases
+    # the GIL) and the group is joined before any of their outputs are forwarded.
+
+    def __init__(self, name, options=None):
+        super().__init__(name, options)
+        self.myPool = None
+        self.workers = None                                                 # None lets the pool choose the number of threads
+        if options and 'workers' in options:
+            self.workers = options['workers']
+        self.fmpyQueued = []                                                # FMPY blocks in the queue, in the order they were added
+        self.taken = {}                                                     # queue entries left behind by blocks taken out with _take_from_queue
+        self.skipped = 0                                                    # the number of these entries still in the queue
+
+    def compile(self):
+        super().compile()
+        if self.myPool is None:
+            self.myPool = ThreadPoolExecutor(max_workers=self.workers)
+
+    def decompile(self):
+        super().decompile()
+        if self.myPool:
+            self.myPool.shutdown()
+            self.myPool = None
+
+    def _process(self, elem):
+        if not isinstance(elem, FMPY) or self.myPool is None:
+            super()._process(elem)
+            return
+
+        group = [elem] + self._take_from_queue(elem.time)
+        if len(group) == 1:
+            super()._process(elem)
+            return
+
+        logging.debug("FMPYGroup element " + self.name + " : stepping " + str(len(group)) + " FMUs at " + str(elem.time))
+        for g in group:                                                     # pending results feeding any member are collected first
+            self._resolve([i for i in self.waiting if self._needs(g, i)])
+        jobs = []
+        for i in group:
+            jobs.append(self.myPool.submit(i.execute))
+        for i in jobs:
+            i.result()                                                      # join; this also re-raises exceptions from the workers
+
+        for i in group:
+            if i.isPending():
+                logging.debug("Element " + i.name + " is pending in canvas " + self.name)
+                self.waiting.append(i)
+                continue
+            self._forward(i)
+
+    def _add_to_queue(self, elem):
+        queued = elem in self.queueElem
+        super()._add_to_queue(elem)
+        if isinstance(elem, FMPY) and not queued and elem in self.queueElem:
+            self.fmpyQueued.append(elem)
+
+    def _get_from_queue(self):
+        while True:
+            elem = self.queue.get()[1]
+            if self.taken.get(elem, 0) == 0:
+                break
+            self.taken[elem] -= 1                                           # an entry left behind by _take_from_queue
+            self.skipped -= 1
+        self.queueElem.remove(elem)
+        if elem in self.fmpyQueued:
+            self.fmpyQueued.remove(elem)
+        self._purge()
+        return elem
+
+    def _take_from_queue(self, time):                                      # takes all other FMPY blocks waiting at the same communication point out of the queue
+        eps = 1.0e-13
+        taken = [i for i in self.fmpyQueued if abs(i.time - time) < eps]
+        for i in taken:
+            self.fmpyQueued.remove(i)
+            self.queueElem.remove(i)
+            self.taken[i] = self.taken.get(i, 0) + 1                        # its entry stays in the queue and is skipped when it comes up
+            self.skipped += 1
+        self._purge()
+        return taken
+
+    def _purge(self):                                                       # empties the queue once only skipped entries are left, so that queue.empty() holds
+        if self.skipped > 0 and self.queue.qsize() == self.skipped:
+            while not self.queue.empty():
+                self.queue.get()
+            self.taken = {}
+            self.skipped = 0
+
+
+
+def _fmpyWorker(name, options, conn, inBuf, outBuf):
+    # runs inside the worker process: owns the FMU and serves the commands of the FMPYProcess element
+    if 'cpu' in options and hasattr(os, 'sched_setaffinity'):
+        os.sched_setaffinity(0, {options['cpu']})
+
+    elem = FMPY(name, options)
+    while True:
+        try:
+            cmd = conn.recv()
+        except EOFError:                                                    # the parent is gone
+            break
+        if cmd == 'quit':
+            break
+        try:
+            for i in range(0, len(elem.input)):
+                elem.input[i]['value'] = inBuf[i]
+            if cmd == 'compile':
+                elem.compile()
+            elif cmd == 'step':
+                elem.doFunc()
+                for i in range(0, len(elem.output)):
+                    outBuf[i] = elem.output[i]['value']
+            elif cmd == 'decompile':
+                elem.decompile()
+            conn.send(cmd)
+        except Exception as e:
+            conn.send(('error', str(e)))
+    conn.close()
+
+
+class FMPYProcess(Element):
+
+    # FMPY block whose FMU lives in a dedicated worker process. Inputs and outputs are exchanged through
+    # shared memory arrays and the worker is driven through a pipe, so a crashing or leaking FMU does not
+    # take down the co-simulation. By default a failed worker raises an exception. With options['restarts']
+    # a failed worker is restarted up to that many times: the new FMU is compiled with the same initial
+    # values and every step since the compile is replayed with its recorded inputs, so the run continues
+    # from the state it had before the crash (this assumes a deterministic FMU).
+    # The worker is started with the 'spawn' method, which imports the main module again: the script that
+    # builds the canvas must start it under if __name__ == "__main__":, otherwise every worker runs it too.
+
+    def __init__(self, name, options):
+        super().__init__(name, options)
+
+        if options['dyn'] != "step" or 'batch' in options or 'signals' in options or 'record' in options:
+            raise Exception("Error! FMPYProcess.init(): Only dyn='step' without batching, signals and recording is supported.")
+
+        for i in options['outputs']:
+            self.createPin('out', VALUETYPES.REAL, i)
+        for i in options['inputs']:
+            self.createPin('in', VALUETYPES.REAL, i)
+        for i in options['x0']:
+            self.createPin('in', VALUETYPES.REAL, i, "init")
+            self.setInputCondition("edge{"+i+"}",'init')
+
+        self.restarts = 0
+        if 'restarts' in options:
+            self.restarts = options['restarts']
+        self.Timeout = 100
+        if 'solOpt' in options and 'Timeout' in options['solOpt']:
+            self.Timeout = options['solOpt']['Timeout']
+
+        self.myProc = None
+        self.myConn = None
+        self.inBuf = None
+        self.outBuf = None
+        self.compileIn = []                                                 # input values of the last compile
+        self.history = []                                                   # input values of every step since the last compile; replayed after a restart
+
+    def _startWorker(self):
+        ctx = multiprocessing.get_context('spawn')                          # a fresh interpreter, nothing of this process is inherited
+        self.inBuf = ctx.Array('d', len(self.input), lock=False)
+        self.outBuf = ctx.Array('d', len(self.output), lock=False)
+        self.myConn, child = ctx.Pipe()
+        self.myProc = ctx.Process(target=_fmpyWorker, args=(self.name, self.options, child, self.inBuf, self.outBuf), daemon=True)
+        self.myProc.start()
+        child.close()
+        logging.debug("FMPYProcess element " + self.name + " : started worker " + str(self.myProc.pid))
+
+    def _stopWorker(self):
+        if self.myProc is None:
+            return
+        try:
+            self.myConn.send('quit')
+        except (OSError, EOFError):
+            pass
+        self.myProc.join(1.0)
+        if self.myProc.is_alive():
+            self.myProc.terminate()
+            self.myProc.join()
+        self.myConn.close()
+        self.myProc = None
+
+    def _call(self, cmd, values=None):
+        if values is None:
+            values = [i['value'] for i in self.input]
+        for i in range(0, len(values)):
+            self.inBuf[i] = values[i]
+        self.myConn.send(cmd)
+        if not self.myConn.poll(self.Timeout):
+            raise TimeoutError("FMPYProcess: worker did not answer '" + cmd + "' within " + str(self.Timeout) + " s.")
+        ans = self.myConn.recv()
+        if ans != cmd:
+            raise RuntimeError("FMPYProcess: worker failed on '" + cmd + "': " + str(ans[1]))
+
+    def _request(self, cmd):
+        for attempt in range(0, self.restarts + 1):
+            try:
+                if attempt > 0:
+                    self._restart(cmd)
+                self._call(cmd)
+                return
+            except (OSError, EOFError, RuntimeError) as e:                  # TimeoutError and BrokenPipeError are OSErrors
+                logging.error("FMPYProcess element " + self.name + " : " + str(e))
+        raise Exception("FMPYProcess: worker of " + self.name + " failed " + str(self.restarts + 1) + " times on '" + cmd + "'.")
+
+    def _restart(self, cmd):                                                # a new worker brought to the state before the failed command
+        logging.warning("FMPYProcess element " + self.name + " : restarting the worker and replaying " + str(len(self.history)) + " steps.")
+        self._stopWorker()
+        self._startWorker()
+        if cmd == 'compile':
+            return
+        self._call('compile', self.compileIn)
+        for i in self.history:
+            self._call('step', i)
+
+    def doFunc(self):
+        self._request('step')
+        if self.restarts > 0:
+            self.history.append([i['value'] for i in self.input])
+        for i in range(0, len(self.output)):
+            self.output[i]['value'] = self.outBuf[i]
+        logging.debug("FMPYProcess element " + self.name + " : " + str(list(self.outBuf)))
+
+    def compile(self):
+        if self.myProc is None or not self.myProc.is_alive():
+            self._startWorker()
+        self.compileIn = [i['value'] for i in self.input]
+        self.history = []
+        self._request('compile')
+
+    def decompile(self):
+        if self.myProc is not None and self.myProc.is_alive():
+            try:
+                self._call('decompile')
+            except (OSError, EOFError, RuntimeError) as e:
+                logging.error("FMPYProcess element " + self.name + " : " + str(e))
+        self._stopWorker()
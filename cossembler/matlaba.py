@@ -16,83 +16,270 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 
+import logging
+import atexit
+import os
+import re
+import shutil
+import tempfile
+
+import numpy
+import matlab
 import matlab.engine
 from cossembler.eng import Element
 from cossembler.eng import WorldConnector
 from cossembler.eng import VALUETYPES
 
+
+class MATLABPool(object):
+
+    # Starting MATLAB takes tens of seconds, so engines are started once and leased to MATLAB blocks.
+    # A block holds its engine from its first compile to its decompile (also the one of restart()); a
+    # re-compile in between, e.g. by a loop, keeps the engine and only clears the block's own function.
+    # A returned engine gets its workspace cleared and its working folder restored before the next lease.
+    # Named shared sessions (matlab.engine.shareEngine) are attached to with connect_matlab and never reset.
+    # All engines are shut down when the process exits.
+
+    def __init__(self, size=1):
+        self.size = size
+        self.free = []
+        self.busy = []
+        self.home = {}                                                  # engine -> working folder at start
+        self.shared = {}                                                # session name -> engine
+
+    def setSize(self, size):
+        self.size = size
+
+    def start(self, n=None):                                            # starts the engines ahead of the first lease
+        if n is None:
+            n = self.size
+        pom = []
+        for i in range(len(self.free) + len(self.busy), n):
+            pom.append(matlab.engine.start_matlab(background=True))     # the engines start concurrently
+        for i in pom:
+            self._add(i.result())
+
+    def _add(self, eng):
+        self.home[eng] = eng.pwd()
+        self.free.append(eng)
+
+    def lease(self, shared=None):
+        if shared:
+            if shared not in self.shared:
+                self.shared[shared] = matlab.engine.connect_matlab(shared)
+            return self.shared[shared]
+        if not self.free:
+            if len(self.busy) >= self.size:
+                logging.warning("MATLABPool: all " + str(self.size) + " engines are leased, starting an additional one.")
+            self._add(matlab.engine.start_matlab())
+        eng = self.free.pop()
+        self.busy.append(eng)
+        return eng
+
+    def release(self, eng):
+        if eng not in self.busy:                                        # shared sessions stay as they are
+            return
+        self.busy.remove(eng)
+        try:
+            eng.eval("clear all", nargout=0)
+            eng.cd(self.home[eng], nargout=0)
+            self.free.append(eng)
+        except Exception as e:                                          # the engine died while leased
+            logging.error("MATLABPool: dropping engine after failed reset: " + str(e))
+            self.home.pop(eng, None)
+
+    def shutdown(self):
+        for eng in self.free + self.busy + list(self.shared.values()):
+            try:
+                eng.quit()
+            except Exception:
+                pass
+        self.free = []
+        self.busy = []
+        self.home = {}
+        self.shared = {}
+
+
+enginePool = MATLABPool()
+atexit.register(enginePool.shutdown)
+
 class MATLAB(Element,WorldConnector):
 
+    fnameCount = 0  # numbers the generated MATLAB functions, so that names cut to the identifier length never collide
+
     def __init__(self,name,type,options=None):
         super().__init__(name,options)
         self.createFlexInputPin()
         self.createPin('out', type)
         self.cmd = []
+        self.initCmd = []                                               # commands ran only in the first call after compile
+        self.persist = []                                               # MATLAB variables kept between calls
         self.var = []
+        self.varPins = []                                               # the input pins of every variable; several pins are packed row by row
+        self.outPins = []                                               # the output pins of every output command; a result is split row by row
+        MATLAB.fnameCount += 1
+        self.fname = "cosm" + str(MATLAB.fnameCount) + "_" + re.sub("[^A-Za-z0-9_]", "_", name)[:50]    # the MATLAB function generated from the commands
+        self.scriptDir = None
+        self.numpyOut = bool(options and 'numpy' in options and options['numpy'])
+        self.asyncCall = bool(options and 'async' in options and options['async'])  # submit the call and let the Canvas collect the result when it is needed
+        self.future = None
+        self.eng = None
 
     def setCommand(self, cmd):  # sets a command to be ran in the tool
         self.cmd.append({'cmd': cmd, 'out': False})
 
-    def setOutCommand(self, cmd):  # sets a command to be ran in the tool + retrieves the output
+    def setOutCommand(self, cmd, pins=None):  # sets a command to be ran in the tool + retrieves the output (into the given output pins)
+        self.outPins.append(pins if pins else [len(self.outPins) + 1])
         self.cmd.append({'cmd': cmd, 'out': True})
 
-    def setVar(self, var):  # sets variables to be initialized with the Element inputs
+    def setVar(self, var, pins=None):  # sets variables to be initialized with the Element inputs (from the given input pins)
+        self.varPins.append(pins if pins else [len(self.var) + 1])
         self.var.append(var)
 
-    def doFunc(self):
-        for i in range(0, len(self.var)):
-            self.eng.workspace[self.var[i]] = self.input[i]['value']
-            if self.input[i]['type'] == VALUETYPES.VECTOR:                                  # TODO: this might not work for matrices
-                y = self.eng.evalc(self.var[i]+"=double(cell2mat("+self.var[i]+"))'")
+    def setInitCommand(self, cmd):  # sets a command to be ran in the tool only once, in the first call
+        self.initCmd.append(cmd)
 
-        cnt = 0
+    def setPersistent(self, var):  # sets variables to keep their values from one call to the next
+        self.persist.append(var)
 
-        for i in range(0, len(self.cmd)):
-            print(self.cmd[i])
-            pom = []
-            if self.cmd[i]['out']:
-                y = self.eng.eval(self.cmd[i]['cmd'])
-                if isinstance(y,complex) or isinstance(y,dict) or isinstance(y,list):
-                    raise Exception("MATLAB.doFunc(): MATLAB returned a type that is not supported by the platform.")
-                if 'size' in dir(y):
-                    k = len(y.size)
-                else:
-                    k = 0
-                if k>0:
-                    for i in range(0,y.size[0]):
-                        pp = []
-                        for j in range(0,y.size[1]):
-                            pp.append(y[i][j])
-                        if y.size[0]==1:
-                            pom = pp
-                        else:
-                            pom.append(pp)
-                else:
-                    pom = y
-                print(y)
-                if (cnt>=len(self.output)):
-                    print("Error! Trying to assign a value to a nonexisting output pin. Create a new output pin to communicate this value.")
-                if isinstance(pom,float):
-                    self.output[cnt]['value'] = pom
-                else:
-                    if len(pom)==1:
-                        self.output[cnt]['value'] = pom[0]
-                    else:
-                        self.output[cnt]['value'] = pom
+    def _terminate(self, cmd):
+        pom = cmd.strip()
+        if pom.endswith(";"):
+            return pom
+        return pom + ";"
+
+    def _writeFunction(self):
+        # All commands are compiled into one MATLAB function which takes the variables as arguments and returns
+        # the results of the output commands as fields y1, y2, ... of one struct, so that each step is one call.
+        lines = ["function out = " + self.fname + "(" + ", ".join(self.var) + ")", "out = struct();"]
+        for i in self.var:                                                  # VECTOR inputs arrive as cell arrays
+            lines.append("if iscell(" + i + "), " + i + " = double(cell2mat(" + i + "))'; end")
+        if self.initCmd or self.persist:                                    # persistent variables live until the function is cleared at the next compile
+            lines.append("persistent cosmInit " + " ".join(self.persist))
+            lines.append("if isempty(cosmInit)")
+            for i in self.initCmd:
+                lines.append(self._terminate(i))
+            lines.append("cosmInit = true;")
+            lines.append("end")
+        cnt = 0
+        for i in self.cmd:
+            if i['out']:
                 cnt += 1
+                lines.append("out.y" + str(cnt) + " = " + i['cmd'].strip() + ";")
             else:
-                y = self.eng.evalc(self.cmd[i]['cmd'])
-                print(y)
+                lines.append(self._terminate(i['cmd']))
+        lines.append("end")
+
+        if self.scriptDir is None:
+            self.scriptDir = tempfile.mkdtemp(prefix="cossembler_")
+        with open(os.path.join(self.scriptDir, self.fname + ".m"), "w") as f:
+            f.write("\n".join(lines) + "\n")
+        logging.debug("MATLAB element " + self.name + " : compiled " + str(len(self.cmd)) + " commands into " + self.fname + ".m")
+
+    def _toMatlab(self, val, type):
+        # VECTOR inputs are passed as one column matlab.double, MATRIX inputs as one 2-D matlab.double; both
+        # are built from a contiguous NumPy buffer instead of letting the engine convert a list element by element
+        if type != VALUETYPES.VECTOR and type != VALUETYPES.MATRIX:
+            return val
+        arr = numpy.asarray(val, dtype=numpy.float64)
+        if type == VALUETYPES.VECTOR:
+            arr = arr.reshape(-1, 1)
+        try:
+            return matlab.double(arr)                                   # engines from R2022a take NumPy arrays directly
+        except (TypeError, ValueError):
+            return matlab.double(arr.tolist())
+
+    def _fromMatlab(self, y):
+        # converts a returned matlab array through its buffer; a 1x1 result becomes a scalar, a row a 1-D
+        # sequence and anything else a 2-D one (as NumPy arrays if options['numpy'] is set, lists otherwise)
+        if isinstance(y,complex) or isinstance(y,dict) or isinstance(y,list):
+            raise Exception("MATLAB.doFunc(): MATLAB returned a type that is not supported by the platform.")
+        if not hasattr(y, 'size'):
+            return y
+        if hasattr(y, '_data'):                                         # column-major array.array of older engines
+            arr = numpy.frombuffer(y._data, dtype=y._data.typecode).reshape(y.size, order='F')
+        else:
+            arr = numpy.asarray(y)
+        if arr.size == 1:
+            return arr.item()
+        if arr.ndim == 2 and arr.shape[0] == 1:
+            arr = arr[0]
+        if self.numpyOut:
+            return arr.copy()                                           # do not keep a view into the engine's buffer
+        return arr.tolist()
+
+    def doFunc(self):
+        self.resolve()                                                  # one call at a time per element
+        args = []
+        for pins in self.varPins:
+            if len(pins) == 1:
+                args.append(self._toMatlab(self.input[pins[0]-1]['value'], self.input[pins[0]-1]['type']))
+            else:                                                       # one row per pin
+                args.append(self._toMatlab(numpy.vstack([numpy.asarray(self.input[i-1]['value'], dtype=numpy.float64) for i in pins]), VALUETYPES.MATRIX))
+
+        if self.asyncCall:
+            self.future = self.eng.feval(self.fname, *args, nargout=1, background=True)
+            logging.debug("MATLAB element " + self.name + " : call submitted")
+            return
+        self._setOutputs(self.eng.feval(self.fname, *args, nargout=1))
+
+    def isPending(self):
+        return self.future is not None
+
+    def resolve(self):
+        if self.future is None:
+            return
+        pom = self.future
+        self.future = None
+        self._setOutputs(pom.result())
+        self._cachePending()
+
+    def _setOutputs(self, y):
+        for cnt in range(0, len(y)):
+            pins = self.outPins[cnt]
+            if max(pins)>len(self.output):
+                logging.error("Error! Trying to assign a value to a nonexisting output pin. Create a new output pin to communicate this value.")
+                break
+            pom = self._fromMatlab(y["y" + str(cnt + 1)])
+            if len(pins) == 1:
+                self.output[pins[0]-1]['value'] = pom
+                continue
+            pom = numpy.asarray(pom)
+            for j in range(0, len(pins)):                               # one row per pin
+                if pom[j].ndim == 0:
+                    self.output[pins[j]-1]['value'] = float(pom[j])
+                elif self.numpyOut:
+                    self.output[pins[j]-1]['value'] = pom[j].copy()
+                else:
+                    self.output[pins[j]-1]['value'] = pom[j].tolist()
+
+        logging.debug("MATLAB element " + self.name + " : " + str([i['value'] for i in self.output]))
 
 
     def connectToTheWorld(self):
-        self.eng = matlab.engine.start_matlab()
+        shared = None
+        if self.options and 'matlab_session' in self.options:             # name of a shared MATLAB session to attach to
+            shared = self.options['matlab_session']
+        self.eng = enginePool.lease(shared)
 
     def disconnectFromTheWorld(self):
-        self.eng.quit()
+        enginePool.release(self.eng)
+        self.eng = None
 
     def compile(self):
-        self.connectToTheWorld()
+        if self.eng is None:                                            # re-compiled by a loop: the engine stays leased until decompile
+            self.connectToTheWorld()
+        self._writeFunction()
+        self.eng.addpath(self.scriptDir, nargout=0)
+        self.eng.eval("clear " + self.fname, nargout=0)                # drop a cached version and its persistent variables, so initCmd runs again
 
     def decompile(self):
+        if self.future is not None:
+            self.future.cancel()
+            self.future = None
+        if self.eng is None:
+            return
+        self.eng.rmpath(self.scriptDir, nargout=0)
         self.disconnectFromTheWorld()
+        shutil.rmtree(self.scriptDir, ignore_errors=True)
+        self.scriptDir = None
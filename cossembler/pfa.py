@@ -0,0 +1,419 @@
+# Cossembler - rapid prototyping tool for energy system co-simulation
+# Copyright (C) 2019  M. Cvetkovic
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import logging
+import os
+import re
+
+import numpy
+import scipy.sparse as sparse
+from scipy.sparse.linalg import spsolve
+from scipy.sparse.linalg import splu
+
+from cossembler.eng import Element
+from cossembler.eng import VALUETYPES
+
+
+# MATPOWER case columns (0-based)
+BUS_I, BUS_TYPE, PD, QD, GS, BS, VM, VA = 0, 1, 2, 3, 4, 5, 7, 8
+GEN_BUS, PG, QG, VG, GEN_STATUS = 0, 1, 2, 5, 7
+F_BUS, T_BUS, BR_R, BR_X, BR_B, TAP, SHIFT, BR_STATUS = 0, 1, 2, 3, 4, 8, 9, 10
+PQ, PV, REF, NONE = 1, 2, 3, 4
+
+
+def loadCase(model, path=""):                                           # reads baseMVA, bus, gen and branch from a MATPOWER case file (e.g. case14.m)
+    fname = model if model.endswith(".m") else model + ".m"
+    if path:
+        fname = os.path.join(path, fname)
+    if not os.path.isfile(fname):
+        raise Exception("loadCase(): MATPOWER case file " + fname + " does not exist.")
+    with open(fname) as f:
+        text = re.sub("%[^\n]*", "", f.read())                          # drop the comments
+
+    case = {}
+    pom = re.search(r"\w+\.baseMVA\s*=\s*([-+.\deE]+)", text)
+    if pom is None:
+        raise Exception("loadCase(): baseMVA is missing in " + fname + ".")
+    case['baseMVA'] = float(pom.group(1))
+    for key in ['bus', 'gen', 'branch']:
+        pom = re.search(r"\w+\." + key + r"\s*=\s*\[(.*?)\]", text, re.S)
+        if pom is None:
+            raise Exception("loadCase(): Matrix " + key + " is missing in " + fname + ".")
+        rows = [i.split() for i in re.split("[;\n]", pom.group(1)) if i.strip()]
+        case[key] = numpy.array(rows, dtype=numpy.float64)
+    return case
+
+
+def makeYbus(baseMVA, bus, branch):                                     # bus admittance matrix and branch from/to admittance matrices, as in MATPOWER
+    nb = bus.shape[0]
+    nl = branch.shape[0]
+    busIdx = {int(b): i for i, b in enumerate(bus[:, BUS_I])}
+    f = numpy.array([busIdx[int(i)] for i in branch[:, F_BUS]], dtype=int)
+    t = numpy.array([busIdx[int(i)] for i in branch[:, T_BUS]], dtype=int)
+
+    stat = branch[:, BR_STATUS]
+    Ys = stat / (branch[:, BR_R] + 1j * branch[:, BR_X])
+    Bc = stat * branch[:, BR_B]
+    tap = numpy.ones(nl, dtype=complex)
+    pom = branch[:, TAP] != 0
+    tap[pom] = branch[pom, TAP]
+    tap = tap * numpy.exp(1j * numpy.pi / 180.0 * branch[:, SHIFT])
+    Ytt = Ys + 1j * Bc / 2
+    Yff = Ytt / (tap * numpy.conj(tap))
+    Yft = -Ys / numpy.conj(tap)
+    Ytf = -Ys / tap
+    Ysh = (bus[:, GS] + 1j * bus[:, BS]) / baseMVA
+
+    rows = numpy.r_[numpy.arange(nl), numpy.arange(nl)]
+    cols = numpy.r_[f, t]
+    Yf = sparse.csr_matrix((numpy.r_[Yff, Yft], (rows, cols)), (nl, nb))
+    Yt = sparse.csr_matrix((numpy.r_[Ytf, Ytt], (rows, cols)), (nl, nb))
+    Cf = sparse.csr_matrix((numpy.ones(nl), (numpy.arange(nl), f)), (nl, nb))
+    Ct = sparse.csr_matrix((numpy.ones(nl), (numpy.arange(nl), t)), (nl, nb))
+    Ybus = (Cf.T @ Yf + Ct.T @ Yt + sparse.diags(Ysh)).tocsr()
+    return Ybus, Yf, Yt, f, t
+
+
+def makeB(baseMVA, bus, branch):                                        # B' and B'' of the XB fast-decoupled method
+    pomBus = bus.copy()
+    pomBus[:, BS] = 0
+    pomBranch = branch.copy()
+    pomBranch[:, BR_B] = 0
+    pomBranch[:, SHIFT] = 0
+    pomBranch[:, TAP] = 1
+    pomBranch[:, BR_R] = 0
+    Bp = -makeYbus(baseMVA, pomBus, pomBranch)[0].imag
+
+    pomBranch = branch.copy()
+    pomBranch[:, SHIFT] = 0
+    Bpp = -makeYbus(baseMVA, bus, pomBranch)[0].imag
+    return Bp.tocsr(), Bpp.tocsr()
+
+
+def busTypes(bus, gen):                                                 # indices of the reference, PV and PQ buses
+    busIdx = {int(b): i for i, b in enumerate(bus[:, BUS_I])}
+    genOn = numpy.zeros(bus.shape[0], dtype=bool)
+    for i in range(0, gen.shape[0]):
+        if gen[i, GEN_STATUS] > 0:
+            genOn[busIdx[int(gen[i, GEN_BUS])]] = True
+    types = bus[:, BUS_TYPE]
+    ref = numpy.flatnonzero((types == REF) & genOn)
+    pv = numpy.flatnonzero((types == PV) & genOn)
+    pq = numpy.flatnonzero((types == PQ) | (((types == PV) | (types == REF)) & ~genOn))
+    if len(ref) == 0:
+        raise Exception("busTypes(): The case has no reference bus with a generator in service.")
+    return ref, pv, pq
+
+
+def _mismatch(Ybus, V, Sbus):
+    return V * numpy.conj(Ybus @ V) - Sbus
+
+
+def newtonPF(Ybus, Sbus, V0, ref, pv, pq, tol=1e-8, maxIt=10):          # full Newton-Raphson in polar coordinates; returns V, converged, iterations
+    V = V0.copy()
+    Va = numpy.angle(V)
+    Vm = numpy.abs(V)
+    pvpq = numpy.r_[pv, pq]
+    n = len(pvpq)
+
+    mis = _mismatch(Ybus, V, Sbus)
+    F = numpy.r_[mis[pvpq].real, mis[pq].imag]
+    if numpy.linalg.norm(F, numpy.inf) < tol:
+        return V, True, 0
+
+    for i in range(1, maxIt + 1):
+        Ibus = Ybus @ V
+        diagV = sparse.diags(V)
+        diagIbus = sparse.diags(Ibus)
+        diagVnorm = sparse.diags(V / numpy.abs(V))
+        dS_dVm = (diagV @ numpy.conj(Ybus @ diagVnorm) + numpy.conj(diagIbus) @ diagVnorm).tocsr()
+        dS_dVa = (1j * diagV @ numpy.conj(diagIbus - Ybus @ diagV)).tocsr()
+
+        J11 = dS_dVa[pvpq, :][:, pvpq].real
+        J12 = dS_dVm[pvpq, :][:, pq].real
+        J21 = dS_dVa[pq, :][:, pvpq].imag
+        J22 = dS_dVm[pq, :][:, pq].imag
+        J = sparse.vstack([sparse.hstack([J11, J12]), sparse.hstack([J21, J22])], format='csc')
+
+        dx = -spsolve(J, F)
+        Va[pvpq] += dx[:n]
+        Vm[pq] += dx[n:]
+        V = Vm * numpy.exp(1j * Va)
+        Vm = numpy.abs(V)
+        Va = numpy.angle(V)
+
+        mis = _mismatch(Ybus, V, Sbus)
+        F = numpy.r_[mis[pvpq].real, mis[pq].imag]
+        if numpy.linalg.norm(F, numpy.inf) < tol:
+            return V, True, i
+    return V, False, maxIt
+
+
+def factorB(Bp, Bpp, pv, pq):                                          # LU factors of the reduced B' and B''; they only change with the topology
+    pvpq = numpy.r_[pv, pq]
+    luP = splu(Bp[pvpq, :][:, pvpq].tocsc())
+    luQ = splu(Bpp[pq, :][:, pq].tocsc()) if len(pq) > 0 else None
+    return luP, luQ
+
+
+def fdPF(Ybus, Sbus, V0, luP, luQ, ref, pv, pq, tol=1e-8, maxIt=30):    # XB fast-decoupled power flow with the factors of factorB; returns V, converged, iterations
+    V = V0.copy()
+    Va = numpy.angle(V)
+    Vm = numpy.abs(V)
+    pvpq = numpy.r_[pv, pq]
+
+    def mismatch(V, Vm):                                                # scaled P and Q mismatches and their largest entry
+        mis = _mismatch(Ybus, V, Sbus) / Vm
+        P = mis[pvpq].real
+        Q = mis[pq].imag
+        return P, Q, numpy.max(numpy.abs(numpy.r_[P, Q]))
+
+    P, Q, err = mismatch(V, Vm)
+    if err < tol:
+        return V, True, 0
+
+    for i in range(1, maxIt + 1):
+        Va[pvpq] -= luP.solve(P)
+        V = Vm * numpy.exp(1j * Va)
+        P, Q, err = mismatch(V, Vm)
+        if err < tol:
+            return V, True, i
+
+        if luQ is not None:
+            Vm[pq] -= luQ.solve(Q)
+            V = Vm * numpy.exp(1j * Va)
+            P, Q, err = mismatch(V, Vm)
+            if err < tol:
+                return V, True, i
+    return V, False, maxIt
+
+
+class NativePF(Element):
+
+    # In-process power flow on a MATPOWER case file, a replacement for runpf that needs neither MATLAB nor
+    # MATPOWER. Inputs and outputs follow PowerFlow: 'Pd', 'Qd', 'Pg', 'Vg' (whole vectors or entries indexed
+    # by the rows of the bus/gen matrix as in MATLAB: 'Pd(2)', 'Pd([2 5 9])' or 'Pd(2:5)') and 'slack'; outputs 'Vm', 'Va' (degrees),
+    # 'Pd', 'Qd', 'Pg', 'Qg' and the 2 x nbranch matrices 'Pflow', 'Qflow' and 'PQloss' in MW/MVAr.
+    # options['pf_alg'] chooses 'NR' (Newton-Raphson, default) or 'FDXB' (fast-decoupled); every solve
+    # starts from the previous solution unless options['warm_start'] is False. The case is read once at
+    # compile; Ybus, the bus types and the B'/B'' factors are kept until the topology (branch and generator
+    # status, bus types) changes, so a step with new loads costs only the iterations. With options['batch']
+    # Pd/Qd inputs carry one snapshot per row (snapshots x buses, or a vector for 'Pd(i)'); the snapshots
+    # are solved one after another, each starting from the previous one, and every output gets one row per
+    # snapshot (flows as snapshots x [from flows, to flows]).
+
+    def __init__(self,name,type,options):
+        super().__init__(name,options)
+        self.createFlexInputPin()
+        self.createPin('out', type)
+        if 'inputs' not in options:
+            raise Exception("NativePF.init(): Inputs must be provided.")
+        if 'outputs' not in options:
+            raise Exception("NativePF.init(): Outputs must be provided.")
+        self.inputs = [self.parsePin(i) for i in options['inputs']]
+        self.outputs = [self.parsePin(i) for i in options['outputs']]
+        self.alg = options['pf_alg'] if 'pf_alg' in options else 'NR'
+        if self.alg not in ['NR', 'FDXB']:
+            raise Exception("NativePF.init(): pf_alg can either be 'NR' or 'FDXB'.")
+        self.tol = options['pf_tol'] if 'pf_tol' in options else 1e-8
+        self.maxIt = options['pf_max_it'] if 'pf_max_it' in options else (10 if self.alg == 'NR' else 30)
+        self.warmStart = options['warm_start'] if 'warm_start' in options else True
+        self.numpyOut = bool('numpy' in options and options['numpy'])
+        self.batch = bool('batch' in options and options['batch'])
+        self.case = None
+        self.V = None                                                   # the last converged solution
+        self.net = None                                                 # network matrices and index sets of the current topology
+        self.topology = None
+
+    def parsePin(self, s):                                              # 'Pd(2)' -> ('Pd', 1); 'Pd([2 5])' and 'Pd(2:5)' -> ('Pd', array of rows); 'Pd' -> ('Pd', None)
+        pom = re.match(r"^\s*(\w+)\s*(?:\((.*)\))?\s*$", s)
+        if pom is None:
+            raise Exception("NativePF.parsePin(): Cannot parse " + s + ".")
+        idx = pom.group(2)
+        if idx is None:
+            return (pom.group(1), None)
+        idx = idx.strip()
+        if re.match(r"^\d+$", idx):
+            return (pom.group(1), int(idx) - 1)                         # MATPOWER rows start at 1
+        vec = re.match(r"^\[\s*(\d+(?:[\s,]+\d+)*)\s*\]$", idx)
+        rng = re.match(r"^(\d+)\s*:\s*(?:(\d+)\s*:\s*)?(\d+)$", idx)
+        if vec is not None:
+            rows = [int(i) for i in re.split(r"[\s,]+", vec.group(1))]
+        elif rng is not None:
+            step = int(rng.group(2)) if rng.group(2) is not None else 1
+            rows = list(range(int(rng.group(1)), int(rng.group(3)) + 1, step))
+        else:
+            raise Exception("NativePF.parsePin(): Cannot parse the index of " + s + "; use a number, [a b c] or a:b.")
+        return (pom.group(1), numpy.array(rows, dtype=int) - 1)
+
+    def pinType(self, s):                                               # the output pin type of an entry in options['outputs']
+        kind, idx = self.parsePin(s)
+        if kind in ['Pflow', 'Qflow', 'PQloss']:
+            return VALUETYPES.MATRIX
+        if idx is None or isinstance(idx, numpy.ndarray):
+            return VALUETYPES.MATRIX if self.batch else VALUETYPES.VECTOR
+        return VALUETYPES.VECTOR if self.batch else VALUETYPES.REAL
+
+    def compile(self):
+        self.case = loadCase(self.options['model'], self.options['model_path'] if 'model_path' in self.options else "")
+        self.V = None
+        self.net = None
+        self.topology = None
+
+    def decompile(self):
+        self.case = None
+        self.V = None
+        self.net = None
+        self.topology = None
+
+    def _snapshots(self):                                               # number of snapshots in the batched inputs
+        for i in range(0, len(self.inputs)):
+            if self.inputs[i][0] in ['Pd', 'Qd']:
+                return len(self.input[i]['value'])
+        raise Exception("NativePF.doFunc(): Batch mode needs a Pd or Qd input.")
+
+    def _applyInputs(self, bus, gen, k=None):                          # k selects the snapshot in batch mode
+        columns = {'Pd': (bus, PD), 'Qd': (bus, QD), 'Pg': (gen, PG), 'Vg': (gen, VG)}
+        for i in range(0, len(self.inputs)):
+            kind, idx = self.inputs[i]
+            val = self.input[i]['value']
+            if k is not None and kind in ['Pd', 'Qd']:
+                val = val[k]
+            if kind == 'slack':
+                bus[bus[:, BUS_TYPE] == REF, BUS_TYPE] = PV
+                bus[int(val) - 1, BUS_TYPE] = REF
+            elif kind in columns:
+                mat, col = columns[kind]
+                if idx is None:
+                    mat[:, col] = numpy.asarray(val, dtype=numpy.float64).ravel()
+                elif isinstance(idx, numpy.ndarray):
+                    mat[idx, col] = numpy.asarray(val, dtype=numpy.float64).ravel()
+                else:
+                    mat[idx, col] = val
+            else:
+                logging.warning("NativePF element " + self.name + " : input " + kind + " is not supported and is ignored.")
+
+    def _network(self, bus, gen, branch):                              # rebuilds the network matrices only if the topology changed
+        pom = (branch[:, BR_STATUS].tobytes(), gen[:, GEN_STATUS].tobytes(), bus[:, BUS_TYPE].tobytes())
+        if pom == self.topology:
+            return self.net
+        logging.debug("NativePF element " + self.name + " : building the network matrices")
+        baseMVA = self.case['baseMVA']
+        nb = bus.shape[0]
+        busIdx = {int(b): i for i, b in enumerate(bus[:, BUS_I])}
+        net = {}
+        net['Ybus'], net['Yf'], net['Yt'], net['f'], net['t'] = makeYbus(baseMVA, bus, branch)
+        net['ref'], net['pv'], net['pq'] = busTypes(bus, gen)
+        net['on'] = numpy.flatnonzero(gen[:, GEN_STATUS] > 0)
+        net['gbus'] = numpy.array([busIdx[int(i)] for i in gen[net['on'], GEN_BUS]], dtype=int)
+        net['Cg'] = sparse.csr_matrix((numpy.ones(len(net['on'])), (net['gbus'], numpy.arange(len(net['on'])))), (nb, len(net['on'])))
+        net['nGen'] = numpy.bincount(net['gbus'], minlength=nb)
+        if self.alg == 'FDXB':
+            Bp, Bpp = makeB(baseMVA, bus, branch)
+            net['luP'], net['luQ'] = factorB(Bp, Bpp, net['pv'], net['pq'])
+        self.net = net
+        self.topology = pom
+        return net
+
+    def _solve(self, bus, gen, branch):
+        baseMVA = self.case['baseMVA']
+        nb = bus.shape[0]
+        net = self._network(bus, gen, branch)
+        Ybus, ref, pv, pq, on, gbus = net['Ybus'], net['ref'], net['pv'], net['pq'], net['on'], net['gbus']
+        Sbus = (net['Cg'] @ (gen[on, PG] + 1j * gen[on, QG]) - (bus[:, PD] + 1j * bus[:, QD])) / baseMVA
+
+        if self.warmStart and self.V is not None and len(self.V) == nb:
+            V0 = self.V.copy()
+        else:
+            V0 = bus[:, VM] * numpy.exp(1j * numpy.pi / 180.0 * bus[:, VA])
+        V0[gbus] = gen[on, VG] / numpy.abs(V0[gbus]) * V0[gbus]          # generator buses are held at their set-points
+
+        if self.alg == 'NR':
+            V, success, it = newtonPF(Ybus, Sbus, V0, ref, pv, pq, self.tol, self.maxIt)
+        else:
+            V, success, it = fdPF(Ybus, Sbus, V0, net['luP'], net['luQ'], ref, pv, pq, self.tol, self.maxIt)
+        if success:
+            logging.debug("NativePF element " + self.name + " : converged in " + str(it) + " iterations")
+            self.V = V
+        else:
+            logging.warning("NativePF element " + self.name + " : power flow did not converge in " + str(it) + " iterations.")
+            self.V = None                                               # do not start the next solve from here
+
+        # generator injections, as in MATPOWER pfsoln (Q is split equally between the generators of one bus)
+        Sg = V[gbus] * numpy.conj(Ybus[gbus, :] @ V)
+        gen[on, QG] = (Sg.imag * baseMVA + bus[gbus, QD]) / net['nGen'][gbus]
+        for r in ref:
+            pom = on[gbus == r]
+            gen[pom[0], PG] = Sg[numpy.flatnonzero(gbus == r)[0]].real * baseMVA + bus[r, PD] - numpy.sum(gen[pom[1:], PG])
+
+        Sf = V[net['f']] * numpy.conj(net['Yf'] @ V) * baseMVA
+        St = V[net['t']] * numpy.conj(net['Yt'] @ V) * baseMVA
+        return V, Sf, St
+
+    def _results(self, bus, gen, V, Sf, St):
+        return {
+            'Vm': numpy.abs(V),
+            'Va': numpy.angle(V) * 180.0 / numpy.pi,
+            'Pd': bus[:, PD],
+            'Qd': bus[:, QD],
+            'Pg': gen[:, PG],
+            'Qg': gen[:, QG],
+            'Pflow': numpy.vstack([Sf.real, St.real]),
+            'Qflow': numpy.vstack([Sf.imag, St.imag]),
+            'PQloss': numpy.vstack([Sf.real + St.real, Sf.imag + St.imag])
+        }
+
+    def doFunc(self):
+        snapshots = [None]
+        if self.batch:
+            snapshots = range(0, self._snapshots())
+        rows = []
+        for k in snapshots:
+            bus = self.case['bus'].copy()
+            gen = self.case['gen'].copy()
+            branch = self.case['branch'].copy()
+            self._applyInputs(bus, gen, k)
+            V, Sf, St = self._solve(bus, gen, branch)
+            rows.append(self._results(bus, gen, V, Sf, St))
+
+        if self.batch:
+            results = {}
+            for key in rows[0]:
+                results[key] = numpy.vstack([i[key].ravel() for i in rows])
+        else:
+            results = rows[0]
+
+        for i in range(0, len(self.outputs)):
+            if i >= len(self.output):
+                logging.error("Error! Trying to assign a value to a nonexisting output pin. Create a new output pin to communicate this value.")
+                break
+            kind, idx = self.outputs[i]
+            if kind not in results:
+                raise Exception("NativePF.doFunc(): Output " + kind + " is not supported.")
+            pom = results[kind]
+            if idx is not None and self.batch:
+                pom = pom[:, idx]
+            elif idx is not None:
+                pom = pom[idx]
+            if idx is not None and not self.batch and not isinstance(idx, numpy.ndarray):
+                self.output[i]['value'] = float(pom)
+            elif self.numpyOut:
+                self.output[i]['value'] = pom.copy()
+            else:
+                self.output[i]['value'] = pom.tolist()
+
+        logging.debug("NativePF element " + self.name + " : " + str([i['value'] for i in self.output]))
@@ -21,8 +21,10 @@ from cossembler.eng import Canvas
 from cossembler.eng import Source
 from cossembler.eng import Sink
 from cossembler.fmpya import FMPY
+from cossembler.fmpya import FMPYProcess
 from cossembler.app import DynamicSimulation
 from cossembler.app import DynamicSimulationNoInit
+from cossembler.app import FusedDynamicSimulation
 from cossembler.eng import VALUETYPES
 
 
@@ -30,13 +32,18 @@ TEST = {
     'MonteCarlo'    : False,          # testing DynamicSimulation block but in a loop with random sources to create Monte Carlo stochastic simulation
     'timeSpanWithX0': True,         # testing DynamicSimulation block (dynamic simulation for entire time period with initialization at start)
     'timeSpan'      : False,        # testing DynamicSimulationNoInit block (dynamic simulation for entire time period without initialization)
-    'singleStep'    : False         # testing FMPY block (single step of dynamic simulation; only tested for FMU for co-simulation version 2)
+    'singleStep'    : False,        # testing FMPY block (single step of dynamic simulation; only tested for FMU for co-simulation version 2)
+    'batchStep'     : False,        # testing FMPY block advancing several communication steps per token (FMU for co-simulation version 2)
+    'fused'         : False,        # testing FusedDynamicSimulation block (the whole interval per token without nested canvases)
+    'signalStep'    : False,        # testing FMPY block interpolating an entire input signal given once (FMU for co-simulation version 2)
+    'recordStep'    : False,        # testing FMPY block with the built-in recorder (the sink receives the recorded points as a numpy array, one row [time, y] per point)
+    'process'       : False         # testing FMPYProcess block (the FMU steps in a worker process; the script must be guarded by if __name__ == "__main__")
 }
 
 FMPYoptions = {
      'solOpt' : {'solver' : 'CVODE', 'fixedStep' : False, 'Timeout': 180, 'Tolerance': 1e-06},
-     'dyn' : 'step', # two possibilities, step and full; only step is working for now
-     'interval' : {'Tstart': 0.0, 'Tstop':1.0, 'Tstep':1.0e-02},  # if dyn=full and inType=variab or outType=variab then Tstep is used to determine the proper size of input and output vectors (user must specify these vectors of size (Tstop-Tstart)/Tstep+1)
+     'dyn' : 'step', # two possibilities, step (one communication step per token) and full (entire interval per token)
+     'interval' : {'Tstart': 0.0, 'Tstop':1.0, 'Tstep':1.0e-02},  # if dyn=full and inType=variab or outType=variab then Tstep is used to determine the proper size of input and output vectors (user must specify these vectors of size (Tstop-Tstart)/Tstep+1); with dyn=full the optional Toutput sets the spacing of the output points (default Tstep)
      'fmu' : r'...\Cossembler\tests\transferFx.fmu',
      'model' : 'transferFx',
      'model_path' : r'...\Cossembler\tests',
@@ -151,12 +158,128 @@ def Main():
             elemSource.connect(elemFM, 1, 'u')
             elemFM.connect(elemSink, 1, 1)
 
+        elif TEST['batchStep']:                                 # the sink receives a vector of 10 output values, one per communication step
+
+            FMPYoptions['tool'] = 'FMU'
+            FMPYoptions['inputs'] = ['u']
+            FMPYoptions['outputs'] = ['y']
+            FMPYoptions['x0'] = []
+            FMPYoptions['batch'] = {'steps': 10, 'hold': 'const'}  # 'const' holds the input during the batch, 'series' expects a VECTOR input with one value per step
+
+            elemFM = FMPY('FMPY', FMPYoptions)
+
+            elemSource = Source('Source', 5.0)
+            elemSink = Sink("Sink")
+
+            wrld.add_element(elemSource)
+            wrld.add_element(elemFM)
+            wrld.add_element(elemSink)
+
+            elemSource.connect(elemFM, 1, 'u')
+            elemFM.connect(elemSink, 1, 1)
+
+
+        elif TEST['fused']:                                     # the sink receives a vector of 100 output values, one per communication step
+
+            FMPYoptions['tool'] = 'FMU'
+            FMPYoptions['inputs'] = ['u_t']
+            FMPYoptions['outputs'] = ['y_t']
+
+            elemFM = FusedDynamicSimulation('DynSimFused', FMPYoptions)
+
+            import numpy as np
+            elemSource = Source('Source', np.linspace(2.0, 2.99, 100), VALUETYPES.VECTOR)
+            elemSink = Sink("Sink")
+
+            wrld.add_element(elemSource)
+            wrld.add_element(elemFM)
+            wrld.add_element(elemSink)
+
+            elemSource.connect(elemFM, 1, 'u_t')
+            elemFM.connect(elemSink, 1, 1)
+
+
+        elif TEST['signalStep']:                                # the input is given once as a vector of samples and interpolated by FMPY at every step
+
+            FMPYoptions['tool'] = 'FMU'
+            FMPYoptions['inputs'] = ['u']
+            FMPYoptions['outputs'] = ['y']
+            FMPYoptions['x0'] = []
+            FMPYoptions['signals'] = ['u']                      # samples at Tstart, Tstart+Tstep, ... unless 'signalTime' gives the time points
+
+            elemFM = FMPY('FMPY', FMPYoptions)
+
+            import numpy as np
+            elemSource = Source('Source', np.linspace(2.0, 2.99, 100), VALUETYPES.VECTOR)
+            elemSink = Sink("Sink")
+
+            elemSource.setCounterCondition(100)
+
+            wrld.add_element(elemSource)
+            wrld.add_element(elemFM)
+            wrld.add_element(elemSink)
+
+            elemSource.connect(elemFM, 1, 'u')
+            elemFM.connect(elemSink, 1, 1)
+
+
+        elif TEST['recordStep']:                                # the sink receives the points recorded every 10 steps so far, the last one holds 11 points
+
+            FMPYoptions['tool'] = 'FMU'
+            FMPYoptions['inputs'] = ['u']
+            FMPYoptions['outputs'] = ['y']
+            FMPYoptions['x0'] = []
+            FMPYoptions['record'] = {'variables': ['y'], 'decimation': 10}     # or 'interval' for the time between two points
+
+            elemFM = FMPY('FMPY', FMPYoptions)
+
+            elemSource = Source('Source', 5.0)
+            elemSink = Sink("Sink")
+
+            elemSource.setCounterCondition(100)
+
+            wrld.add_element(elemSource)
+            wrld.add_element(elemFM)
+            wrld.add_element(elemSink)
+
+            elemSource.connect(elemFM, 1, 'u')
+            elemFM.connect(elemSink, 2, 1)                      # the recorder pin follows the outputs
+
+
+        elif TEST['process']:                                   # the sink receives 10 output values, the same as 10 single steps of the FMPY block
+
+            FMPYoptions['tool'] = 'FMU'
+            FMPYoptions['inputs'] = ['u']
+            FMPYoptions['outputs'] = ['y']
+            FMPYoptions['x0'] = []
+            FMPYoptions['restarts'] = 1                         # a crashed worker is restarted once and the steps so far are replayed
+
+            elemFM = FMPYProcess('FMPY', FMPYoptions)
+
+            elemSource = Source('Source', 5.0)
+            elemSink = Sink("Sink")
+
+            elemSource.setCounterCondition(10)
+
+            wrld.add_element(elemSource)
+            wrld.add_element(elemFM)
+            wrld.add_element(elemSink)
+
+            elemSource.connect(elemFM, 1, 'u')
+            elemFM.connect(elemSink, 1, 1)
+
 
         wrld.start()
 
     except Exception as e:
         if elemFM:
-            if TEST['MonteCarlo']:
+            if TEST['fused'] or TEST['singleStep'] or TEST['batchStep'] or TEST['signalStep'] or TEST['recordStep']:     # elemFM is the FMPY block itself
+                elemFM.myFMU.terminate()
+                elemFM.myFMU.freeInstance()
+                shutil.rmtree(elemFM.unzipdir)
+            elif TEST['process']:                               # the worker cleans up its own FMU
+                elemFM.decompile()
+            elif TEST['MonteCarlo']:
                 elemFM.myTool.myTool.myFMU.terminate()
                 elemFM.myTool.myTool.myFMU.freeInstance()
                 shutil.rmtree(elemFM.myTool.myTool.unzipdir)
@@ -166,4 +289,5 @@ def Main():
                 shutil.rmtree(elemFM.myTool.unzipdir)
         print(e)
 
-Main()
+if __name__ == "__main__":                                      # FMPYProcess workers import this module again
+    Main()
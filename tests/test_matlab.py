@@ -0,0 +1,61 @@
+
+# Cossembler - rapid prototyping tool for energy system co-simulation
+# Copyright (C) 2019  M. Cvetkovic
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from cossembler.eng import Canvas
+from cossembler.eng import Source
+from cossembler.eng import Sink
+from cossembler.eng import ForLoop
+from cossembler.eng import PRIORITY
+from cossembler.eng import VALUETYPES
+from cossembler.matlaba import MATLAB
+
+
+TEST = {
+    'persistent'    : True          # a MATLAB block with a persistent counter inside a loop of 3 runs, inside a loop of 2 runs;
+                                    # the counter keeps its value between the calls and starts over at every compile, so the sink shows 1.0, 2.0, 3.0, 1.0, 2.0, 3.0
+}
+
+def Main():
+
+    wrld = Canvas('world')
+
+    if TEST['persistent']:
+
+        elemOne = Source('one', 1.0)
+        elemStart = Source('start', 0.0)
+        elemML = MATLAB('counter', VALUETYPES.REAL)
+        elemSink = Sink('sink')
+
+        elemML.setVar('u')
+        elemML.setPersistent('n')
+        elemML.setInitCommand('n = 0')                          # runs in the first call after every compile
+        elemML.setCommand('n = n + u')
+        elemML.setOutCommand('n')
+
+        inner = ForLoop('inner', elemOne, 3, options={'priority': PRIORITY.TOP})   # compiles its elements again after every 3 runs
+        inner.add_element(elemML)
+        inner.add_element(elemSink)
+        outer = ForLoop('outer', elemStart, 2, options={'priority': PRIORITY.TOP})
+        outer.add_element(inner)
+        wrld.add_element(outer)
+
+        elemOne.connect(elemML, 1, 1)
+        elemML.connect(elemSink, 1, 1)
+
+    wrld.start()
+
+Main()
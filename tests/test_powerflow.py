@@ -4,25 +4,43 @@ from cossembler.eng import Source
 from cossembler.eng import Sink
 from cossembler.app import PowerFlow
 from cossembler.eng import Index
+from cossembler.eng import VALUETYPES
 
 
 # this file tests MatPower integration. The result observed at sink is the phase angle of the third bus = -12.759
 
+TEST = {
+    'matpower'      : True,
+    'native'        : False         # the in-process solver with an indexed input, Pd([2 3]) = [23.0, 94.2]; the sink shows the same -12.759
+}
+
 PFoptions = {
-    'tool': "MATPOWER",
+    'tool': "MATPOWER",    # 'tool' can be : "MATPOWER" or "NATIVE" (in-process solver; 'model_path' must then point to the folder of the case file, e.g. MATPOWER's installation folder)
     'model': "case14",
     'model_path' : "",
-    'inputs': ['Pd(2)'],  #     'inputs' can be : ['Pd', 'Qd', 'Pg', 'Vg', 'oltc', 'slack', 'elAct'],
+    'inputs': ['Pd(2)'],  #     'inputs' can be : ['Pd', 'Qd', 'Pg', 'Vg', 'slack'], each with an optional index such as 'Pd(2)', 'Pd([2 5 9])' or 'Pd(2:5)'
     'outputs': ['Vm', 'Va', 'Pd', 'Qd', 'Pg', 'Qg', 'Pflow', 'Qflow', 'PQloss']     # 'outputs' can be : ['Vm', 'Va', 'Pd', 'Qd', 'Pg', 'Qg', 'Pflow', 'Qflow', 'PQloss']
 }
 
+PFoptionsNative = {
+    'tool': "NATIVE",
+    'model': "case14",
+    'model_path' : "",     # the folder of case14.m, e.g. MATPOWER's installation folder
+    'inputs': ['Pd([2 3])'],
+    'outputs': ['Vm', 'Va', 'Pd([2 3])']
+}
+
 def Main():
 
     wrld = Canvas('world')
 
-    elemPF = PowerFlow('PowerFlow',PFoptions)
+    if TEST['native']:
+        elemPF = PowerFlow('PowerFlow',PFoptionsNative)
+        elem1 = Source('const1',[23.0, 94.2],VALUETYPES.VECTOR)
+    else:
+        elemPF = PowerFlow('PowerFlow',PFoptions)
+        elem1 = Source('const1',23.0)
 
-    elem1 = Source('const1',23.0)
     elem2 = Sink('sink1')
     elemI = Index("Index", 3)
 
@@ -0,0 +1,215 @@
+# Cossembler - rapid prototyping tool for energy system co-simulation
+# Copyright (C) 2019  M. Cvetkovic
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+from cossembler.eng import Source
+from cossembler.eng import Sink
+from cossembler.eng import Addition
+from cossembler.eng import TXBuffer
+from cossembler.eng import MultiRateCanvas
+from cossembler.eng import EventCanvas
+from cossembler.eng import TimeToValue
+from cossembler.eng import Canvas
+from cossembler.eng import ForLoop
+from cossembler.eng import Gain
+from cossembler.eng import PRIORITY
+from cossembler.eng import VALUETYPES
+from cossembler.eng import ResultCache
+from concurrent.futures import ThreadPoolExecutor
+import time
+import os
+import tempfile
+
+# only one test can be active at a time
+
+TEST = {
+    'multiRate'     : True,         # a fast and a slow block in one MultiRateCanvas; the sink shows 11, 12, 13, 14, 25, 26, 27, 28 at times 0.0 to 7.0
+    'discreteEvent' : False,        # two time-stamped events in an EventCanvas; the sink shows 2.0 at time 2.0 first and 1.0 at time 5.0 second
+    'incremental'   : False,        # a constant source looped 5 times in an incremental ForLoop; the sink shows 10.0 only once
+    'asyncCall'     : False,        # a slow asynchronous gain next to a fast branch; sinkB shows 3.0 before sinkA shows 10.0
+    'resultCache'   : False         # a cached gain of size 2 shows 1 hit and 4 misses; reloaded from its file it shows 1 hit and 1 miss
+}
+
+
+class SlowGain(Gain):                                           # stands in for a MATLAB block with options 'async'
+
+    def __init__(self, name, val, pool):
+        super().__init__(name, val)
+        self.pool = pool
+        self.future = None
+
+    def doFunc(self):
+        self.future = self.pool.submit(self._slowFunc)
+
+    def _slowFunc(self):
+        time.sleep(0.5)
+        Gain.doFunc(self)
+
+    def isPending(self):
+        return self.future is not None
+
+    def resolve(self):
+        if self.future is not None:
+            self.future.result()
+            self.future = None
+
+def Main():
+
+    if sum(TEST.values()) != 1:
+        print("Exactly one test has to be active at a time.")
+        return
+
+    if TEST['multiRate']:
+
+        wrld = MultiRateCanvas('world', {'interval': {'Tstart': 0.0, 'Tstop': 8.0, 'Tstep': 1.0}})
+
+        elemFast = Source('fast', [1.0, 2.0, 3.0, 4.0, 5.0, 6.0, 7.0, 8.0], VALUETYPES.VECTOR)
+        elemSlow = Source('slow', [10.0, 20.0], VALUETYPES.VECTOR)
+        elemFastTX = TXBuffer('fastTX')
+        elemSlowTX = TXBuffer('slowTX')
+        elemAdd = Addition('add')
+        elemSink = Sink('sink')
+
+        elemSlowTX.setRate(4.0)                                 # runs at t = 0 and t = 4 only; in between its output is held
+
+        for i in [elemFast, elemSlow, elemFastTX, elemSlowTX, elemAdd, elemSink]:
+            wrld.add_element(i)
+
+        elemFast.connect(elemFastTX, 1, 1)
+        elemSlow.connect(elemSlowTX, 1, 1)
+        elemFastTX.connect(elemAdd, 1, 1)
+        elemSlowTX.connect(elemAdd, 1, 2)
+        elemAdd.connect(elemSink, 1, 1)
+
+        wrld.start()
+
+    elif TEST['discreteEvent']:
+
+        wrld = EventCanvas('world', {'interval': {'Tstart': 0.0, 'Tstop': 10.0}})
+
+        elemT1 = Source('t1', 5.0)
+        elemV1 = Source('v1', 1.0)
+        elemT2 = Source('t2', 2.0)
+        elemV2 = Source('v2', 2.0)
+        elemEv1 = TimeToValue('event1')                         # stamps the value with the time given at its first pin
+        elemEv2 = TimeToValue('event2')
+        elemSink = Sink('sink')
+
+        for i in [elemT1, elemV1, elemT2, elemV2, elemEv1, elemEv2, elemSink]:
+            wrld.add_element(i)
+
+        elemT1.connect(elemEv1, 1, 1)
+        elemV1.connect(elemEv1, 1, 2)
+        elemT2.connect(elemEv2, 1, 1)
+        elemV2.connect(elemEv2, 1, 2)
+        elemEv1.connect(elemSink, 1, 1)
+        elemEv2.connect(elemSink, 1, 1)
+
+        wrld.start()
+
+    elif TEST['incremental']:
+
+        wrld = Canvas('world')
+
+        elemSource = Source('const', 5.0)
+        elemGain = Gain('gain', 2.0)
+        elemSink = Sink('sink')
+
+        loop = ForLoop('loop', elemSource, 5, options={'priority': PRIORITY.TOP, 'incremental': True})
+        loop.add_element(elemGain)
+        loop.add_element(elemSink)
+        wrld.add_element(loop)
+
+        elemSource.connect(elemGain, 1, 1)
+        elemGain.connect(elemSink, 1, 1)
+
+        wrld.start()
+
+    elif TEST['asyncCall']:
+
+        wrld = Canvas('world')
+
+        elemA = Source('a', 5.0)
+        elemB = Source('b', 1.0)
+        pool = ThreadPoolExecutor(max_workers=1)
+        elemSlow = SlowGain('slow', 2.0, pool)
+        elemFast = Gain('fast', 3.0)
+        elemSinkA = Sink('sinkA')
+        elemSinkB = Sink('sinkB')
+
+        for i in [elemA, elemB, elemSlow, elemFast, elemSinkA, elemSinkB]:
+            wrld.add_element(i)
+
+        elemA.connect(elemSlow, 1, 1)
+        elemSlow.connect(elemSinkA, 1, 1)
+        elemB.connect(elemFast, 1, 1)
+        elemFast.connect(elemSinkB, 1, 1)
+
+        wrld.start()
+        pool.shutdown()
+
+    elif TEST['resultCache']:
+
+        cacheFile = os.path.join(tempfile.gettempdir(), 'cossembler_test_sched.cache')
+        if os.path.exists(cacheFile):
+            os.remove(cacheFile)
+
+        wrld = Canvas('world')
+
+        elemSource = Source('inputs', [1.0, 2.0, 1.0, 3.0, 2.0], VALUETYPES.VECTOR)
+        elemTX = TXBuffer('inputsTX')
+        elemGain = Gain('gain', 2.0)
+        elemSink = Sink('sink')
+
+        elemSource.setCounterCondition(5)
+        elemGain.setCache(2, cacheFile)                         # 1.0 misses, 2.0 misses, 1.0 hits, 3.0 misses and evicts 2.0, 2.0 misses and evicts 1.0
+
+        for i in [elemSource, elemTX, elemGain, elemSink]:
+            wrld.add_element(i)
+
+        elemSource.connect(elemTX, 1, 1)
+        elemTX.connect(elemGain, 1, 1)
+        elemGain.connect(elemSink, 1, 1)
+
+        wrld.start()                                            # decompile() writes the cache to its file
+        print("gain: " + str(elemGain.myCache.hits) + " hits, " + str(elemGain.myCache.misses) + " misses")
+
+        if len(ResultCache(2, cacheFile).store) != 2:
+            print("The cache file must hold exactly 2 entries.")
+
+        wrld2 = Canvas('world2')
+
+        elemSource2 = Source('inputs2', [3.0, 1.0], VALUETYPES.VECTOR)
+        elemTX2 = TXBuffer('inputsTX2')
+        elemGain2 = Gain('gain2', 2.0)
+        elemSink2 = Sink('sink2')
+
+        elemSource2.setCounterCondition(2)
+        elemGain2.setCache(2, cacheFile)                        # 3.0 hits from the file, 1.0 was evicted and misses
+
+        for i in [elemSource2, elemTX2, elemGain2, elemSink2]:
+            wrld2.add_element(i)
+
+        elemSource2.connect(elemTX2, 1, 1)
+        elemTX2.connect(elemGain2, 1, 1)
+        elemGain2.connect(elemSink2, 1, 1)
+
+        wrld2.start()
+        print("gain2: " + str(elemGain2.myCache.hits) + " hits, " + str(elemGain2.myCache.misses) + " misses")
+
+        os.remove(cacheFile)
+
+Main()